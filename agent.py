@@ -1,13 +1,162 @@
 import argparse
-from rec_engine import build_recommendations
+import sys
+import time
+import instrument
 import json
 
+# rec_engine (pandas, numpy) is imported where it is first needed, so --help and
+# argument errors return immediately; see `python bench.py startup`.
+
+def _read_userids(path):
+    with open(path) as fh:
+        return [line.strip() for line in fh if line.strip()]
+
+def run_batch(user_ids, workers, out):
+    from rec_engine import build_recommendations_batch
+    # JSON Lines: one result per user, flushed as soon as it is ready
+    start = time.perf_counter()
+    n = 0
+    for result in build_recommendations_batch(user_ids, workers=workers):
+        out.write(json.dumps(result) + "\n")
+        out.flush()
+        n += 1
+    elapsed = time.perf_counter() - start
+    rate = n / elapsed if elapsed > 0 else float("inf")
+    print(f"{n} users in {elapsed:.2f}s ({rate:.1f} users/s)", file=sys.stderr)
+
+def run_batch_llm(user_ids, args, out):
+    import asyncio
+    from llm_dispatch import dispatcher_from_env, recommend_cohort
+
+    dispatcher = dispatcher_from_env(max_concurrency=args.concurrency, requests_per_second=args.rps,
+                                     timeout=args.llm_timeout)
+    if dispatcher is None:
+        print("--llm needs OPENAI_API_KEY (or OPENAI_BASE_URL for a compatible server); using rule-based batch",
+              file=sys.stderr)
+        return run_batch(user_ids, args.workers, out)
+
+    async def go():
+        start = time.perf_counter()
+        n = 0
+        async with dispatcher:
+            async for result in recommend_cohort(dispatcher, user_ids):
+                out.write(json.dumps(result) + "\n")
+                out.flush()
+                n += 1
+        elapsed = time.perf_counter() - start
+        rate = n / elapsed if elapsed > 0 else float("inf")
+        print(f"{n} users in {elapsed:.2f}s ({rate:.1f} users/s); llm stats: {dispatcher.stats}", file=sys.stderr)
+
+    asyncio.run(go())
+
+def print_prompt_stats(user_id, budget):
+    from rec_engine import DataBundle, catalog_prompt_sample, extract_user_profile, prompt_token_report
+    bundle = DataBundle.load()
+    if not bundle.has_user(user_id):
+        print(f"User {user_id} not found in any data source.", file=sys.stderr)
+        return
+    profile = extract_user_profile(bundle, user_id)
+    report = prompt_token_report(profile, catalog_prompt_sample(bundle), bundle.catalog_index, budget)
+    print(json.dumps(report, indent=2))
+
+def print_memory_report():
+    from rec_engine import DataBundle
+    start = time.perf_counter()
+    bundle = DataBundle.load()
+    bundle.catalog_index  # the catalog is otherwise read on first use; include it
+    elapsed = time.perf_counter() - start
+    usage = bundle.memory_usage()
+    for name, nbytes in usage.items():
+        print(f"{name:<14} {len(getattr(bundle, name)):>10} rows {nbytes / 1e6:>10.2f} MB")
+    print(f"{'total':<14} {'':>15} {sum(usage.values()) / 1e6:>10.2f} MB  (loaded in {elapsed:.2f}s)")
+
+def _run_profiled(fn, path):
+    import cProfile
+    import pstats
+    prof = cProfile.Profile()
+    try:
+        prof.runcall(fn)
+    finally:
+        if path:
+            prof.dump_stats(path)
+            print(f"cProfile stats written to {path} (view with: python -m pstats {path})", file=sys.stderr)
+        else:
+            pstats.Stats(prof, stream=sys.stderr).sort_stats("cumulative").print_stats(30)
+
 def main():
     parser = argparse.ArgumentParser(description="AI Recommendation Agent (CLI)")
-    parser.add_argument("--userid", "-u", required=True, help="USERID to generate recommendations for")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument("--userid", "-u", help="USERID to generate recommendations for")
+    target.add_argument("--all", action="store_true",
+                        help="Batch mode: recommendations for every user in pilot_user_data.csv, as JSON Lines")
+    target.add_argument("--userids-file", help="Batch mode for the USERIDs listed in this file (one per line)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Processes for the batch rule stage (default: CPU count; 1 runs inline)")
+    parser.add_argument("--output", "-o", help="Write batch JSON Lines here instead of stdout")
+    parser.add_argument("--llm", action="store_true",
+                        help="Batch mode: draft LLM recommendations through the async dispatcher (rule-based fallback per user)")
+    parser.add_argument("--concurrency", type=int, default=8, help="Max in-flight LLM requests with --llm")
+    parser.add_argument("--rps", type=float, default=5.0, help="Max LLM requests per second with --llm")
+    parser.add_argument("--llm-timeout", type=float, default=60.0, help="Per-request LLM timeout in seconds with --llm")
+    parser.add_argument("--prompt-stats", action="store_true",
+                        help="With --userid: print estimated LLM prompt tokens before/after compaction instead of recommendations")
+    parser.add_argument("--prompt-budget", type=int, default=None,
+                        help="With --prompt-stats: token budget to compact to (default: $LLM_PROMPT_TOKEN_BUDGET or 1500)")
+    parser.add_argument("--timings", action="store_true",
+                        help="With --userid: include per-stage timings and counters in the result")
+    parser.add_argument("--similar", type=int, nargs="?", const=5, default=0, metavar="K",
+                        help="With --userid: attach the K (default 5) users with the most similar profiles "
+                             "and their stacks (builds the cohort similarity index)")
+    parser.add_argument("--trace-log", help="Append one JSON line of stage timings per request (per user in batch mode) to this file")
+    parser.add_argument("--metrics-file", help="On exit, write stage timings and counters here in Prometheus text format")
+    parser.add_argument("--profile", nargs="?", const="", metavar="PATH",
+                        help="Run under cProfile; print the top functions to stderr, or save the stats to PATH")
+    parser.add_argument("--compile-snapshot", action="store_true",
+                        help="Compile data/ and main.xlsx into the memory-mapped snapshot used for fast loading")
+    parser.add_argument("--memory-report", action="store_true",
+                        help="Load the data and print rows and in-memory size per table")
     args = parser.parse_args()
 
-    result = build_recommendations(args.userid)
+    if args.trace_log:
+        instrument.add_exporter(instrument.JsonLogExporter(args.trace_log))
+    try:
+        if args.profile is not None:
+            _run_profiled(lambda: run(args, parser), args.profile)
+        else:
+            run(args, parser)
+    finally:
+        if args.metrics_file:
+            instrument.METRICS.write_prometheus(args.metrics_file)
+
+def run(args, parser):
+    if args.compile_snapshot:
+        from rec_engine import compile_snapshot
+        print(f"Snapshot written to {compile_snapshot()}")
+    if args.memory_report:
+        print_memory_report()
+    if not (args.userid or args.all or args.userids_file):
+        if args.compile_snapshot or args.memory_report:
+            return
+        parser.error("one of --userid, --all or --userids-file is required")
+
+    if args.all or args.userids_file:
+        if args.timings:
+            parser.error("--timings applies to --userid; for batches use --trace-log (one line per user)")
+        user_ids = None if args.all else _read_userids(args.userids_file)
+        runner = (lambda out: run_batch_llm(user_ids, args, out)) if args.llm else (lambda out: run_batch(user_ids, args.workers, out))
+        if args.output:
+            with open(args.output, "w") as out:
+                runner(out)
+        else:
+            runner(sys.stdout)
+        return
+
+    if args.prompt_stats:
+        print_prompt_stats(args.userid, args.prompt_budget)
+        return
+
+    from rec_engine import build_recommendations
+    result = build_recommendations(args.userid, timings=args.timings, similar=args.similar)
     print(json.dumps(result, indent=2))
 
 if __name__ == "__main__":
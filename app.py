@@ -2,7 +2,7 @@
 import os
 import streamlit as st
 import pandas as pd
-from rec_engine import build_recommendations, DataBundle, assemble_user_dataframe
+from rec_engine import SIMILAR_USERS_K, build_recommendations_stream, DataBundle, assemble_user_dataframe, BUNDLE_CACHE
 
 st.set_page_config(page_title="AI Wellness Recommendation Agent", page_icon="🧬", layout="wide")
 
@@ -17,6 +17,20 @@ with st.expander("ℹ️ How it works"):
     4. Output is **informational only**. Consult a qualified clinician before starting peptides or supplements.
     """)
 
+def render_rule_based(recs):
+    cols = st.columns(3)
+    with cols[0]:
+        st.markdown("### Supplement Stack (info)")
+        st.write("\n".join(f"- {x}" for x in recs.get("supplement_stack", [])) or "_No items_")
+    with cols[1]:
+        st.markdown("### Peptides (info)")
+        st.write("\n".join(f"- {x}" for x in recs.get("peptides", [])) or "_No items_")
+    with cols[2]:
+        st.markdown("### Nootropics (info)")
+        st.write("\n".join(f"- {x}" for x in recs.get("nootropics", [])) or "_No items_")
+    st.markdown("#### Notes")
+    st.write("\n".join(f"- {x}" for x in recs.get("notes", [])))
+
 user_id = st.text_input("Enter USERID", value="")
 
 # buttons and merged-preview flow
@@ -37,9 +51,20 @@ with colA:
         with st.expander("Preview merged user data (first 10 rows)"):
             st.dataframe(merged.head(10))
         if st.button("Generate Recommendations for this user"):
-            with st.spinner("Generating recommendations (LLM or fallback)..."):
-                result = build_recommendations(user_id.strip())
-            st.session_state["result"] = result
+            # render progressively: rule-based placeholder first, then LLM text as it streams in
+            live = st.empty()
+            text = ""
+            for ev in build_recommendations_stream(user_id.strip(), similar=SIMILAR_USERS_K):
+                if ev["event"] == "fallback":
+                    with live.container():
+                        st.caption("Drafting a personalized plan... showing the rule-based suggestions meanwhile.")
+                        render_rule_based(ev["result"]["recommendations"])
+                elif ev["event"] == "delta":
+                    text += ev["text"]
+                    live.markdown(text + " ▌")
+                elif ev["event"] == "done":
+                    st.session_state["result"] = ev["result"]
+            live.empty()
 
 with colB:
     st.markdown("#### Data health check")
@@ -56,6 +81,8 @@ with colB:
         "surveys_adherence_logs.csv": bundle.surveys is not None,
     }
     st.dataframe(pd.DataFrame({"file": list(files_ok.keys()), "loaded": list(files_ok.values())}))
+    cache_stats = BUNDLE_CACHE.stats()
+    st.caption(f"Data cache: {cache_stats['hits']} hits • {cache_stats['misses']} misses • {cache_stats['reloads']} reloads • {cache_stats['appends']} appends")
 
 st.markdown("---")
 
@@ -72,16 +99,17 @@ if res:
     else:
         recs = res.get("recommendations", {})
         if recs:
-            cols = st.columns(3)
-            with cols[0]:
-                st.markdown("### Supplement Stack (info)")
-                st.write("\n".join(f"- {x}" for x in recs.get("supplement_stack", [])) or "_No items_")
-            with cols[1]:
-                st.markdown("### Peptides (info)")
-                st.write("\n".join(f"- {x}" for x in recs.get("peptides", [])) or "_No items_")
-            with cols[2]:
-                st.markdown("### Nootropics (info)")
-                st.write("\n".join(f"- {x}" for x in recs.get("nootropics", [])) or "_No items_")
-            st.markdown("#### Notes")
-            st.write("\n".join(f"- {x}" for x in recs.get("notes", [])))
+            render_rule_based(recs)
+
+    similar = res.get("similar_users")
+    if similar:
+        with st.expander(f"Users with similar profiles ({len(similar['neighbors'])})"):
+            if similar["common_stack"]:
+                st.markdown("**Most common active stack among them**")
+                st.dataframe(pd.DataFrame(similar["common_stack"]))
+            st.dataframe(pd.DataFrame([
+                {"similarity": n["similarity"], "stack": ", ".join(item["name"] for item in n["stack"]) or "-",
+                 "check-in days (30d)": n["check_in_days_30d"]}
+                for n in similar["neighbors"]
+            ]))
     st.info("Disclaimer: This output is for **information only** and is **not medical advice**. Always consult a qualified clinician before making changes.")
@@ -0,0 +1,689 @@
+"""Benchmark harness for the recommendation pipeline.
+
+  python bench.py generate --out bench_data --users 100000 --days 90
+  python bench.py run --data bench_data --output results.json
+  python bench.py compare before.json after.json
+  python bench.py startup --budget-ms 600
+  python bench.py ingest-check
+
+``generate`` writes a synthetic dataset with the same layout and schemas as the
+repo (``data/*.csv`` plus ``main.xlsx``), in user chunks so that 100k+ users and
+tens of millions of wearable rows fit in memory. ``run`` times each pipeline
+stage over a sample of users and writes p50/p95 latency and peak RSS as JSON;
+``compare`` prints the ratio between two such runs. ``startup`` measures what a
+one-shot ``agent.py`` invocation pays before doing any work (``-X importtime``)
+and exits non-zero when importing ``rec_engine`` -- what ``agent.py -u`` imports
+before loading data -- exceeds ``--budget-ms``.
+``ingest-check`` grows, truncates and rewrites a copy of the CSVs, refreshing
+through the append-only cache after each step, and exits non-zero when the
+result differs from a full reload.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+# ---- Synthetic data ----
+_ANCHOR = np.datetime64("2025-10-09")
+
+# (loinc, test, unit, ref_low, ref_high, mean, sd) as in structured_lab_results.csv
+_LAB_TESTS = [
+    ("718-7", "Hemoglobin", "g/dL", 13.5, 17.5, 14.6, 1.4),
+    ("4544-3", "Hematocrit", "%", 41.0, 53.0, 43.9, 4.4),
+    ("6690-2", "WBC", "x10³/µL", 4.0, 11.0, 7.5, 2.0),
+    ("777-3", "Platelets", "x10³/µL", 150.0, 450.0, 303.0, 84.0),
+    ("2345-7", "Fasting Glucose", "mg/dL", 70.0, 99.0, 92.0, 15.0),
+    ("4548-4", "A1c", "%", 4.0, 5.6, 5.1, 0.7),
+    ("13457-7", "LDL", "mg/dL", 50.0, 99.0, 93.0, 34.0),
+    ("2085-9", "HDL", "mg/dL", 40.0, 80.0, 65.0, 12.5),
+    ("2571-8", "Triglycerides", "mg/dL", 50.0, 149.0, 120.0, 42.0),
+    ("30522-7", "hs-CRP", "mg/L", 0.1, 1.0, 0.9, 0.7),
+    ("1988-5", "Vitamin D", "ng/mL", 20.0, 50.0, 35.0, 8.5),
+]
+_PROVIDERS = ["Phoenix Diagnostics", "Quest Diagnostics", "LabCorp"]
+# (name, rxnorm, doses)
+_MEDS = [
+    ("Vitamin D3", None, ["4000 IU"]), ("Magnesium Glycinate", None, ["200 mg", "300 mg"]),
+    ("Coenzyme Q10", None, ["100 mg"]), ("NMN", None, ["250 mg", "500 mg"]),
+    ("Omega-3 Fish Oil", None, ["1200 mg"]), ("Ashwagandha", None, ["300 mg"]),
+    ("Metformin", "6809", ["500 mg"]), ("Lisinopril", "29046", ["10 mg", "20 mg"]),
+    ("Atorvastatin", "83367", ["10 mg", "20 mg"]),
+]
+_FREQUENCIES = ["once daily", "in morning", "in evening", "at bedtime", "twice daily"]
+_TAXA = ["Bacteroides", "Faecalibacterium", "Bifidobacterium", "Lactobacillus", "Akkermansia"]
+_METABOLITES = [("HMDB0000122", "Leucine", 118.5, 34.4)]
+_QUESTIONS = ["q_stress_level", "q_fatigue_level"]
+_FIRST = ["Stephanie", "Donna", "James", "Maria", "Wei", "Amir", "Olga", "Kofi", "Lucia", "Noah"]
+_LAST = ["Hunter", "Merritt", "Nguyen", "Garcia", "Smith", "Okafor", "Kowalski", "Rossi", "Tanaka", "Berg"]
+_CATALOG_THEMES = ["sleep quality", "recovery and repair", "cognition and memory", "inflammation",
+                   "cardiovascular health", "metabolic and glucose control", "immune support",
+                   "bone density", "energy and fatigue", "stress resilience", "neuroprotection", "longevity"]
+_MECHANISMS = ["GLP-1 receptor agonist", "growth hormone secretagogue", "angiogenesis promoter",
+               "BDNF upregulation", "mitochondrial support", "anti-oxidant", "melanocortin agonist"]
+_AMINO = np.array(list("ACDEFGHIKLMNPQRSTVWY"))
+
+
+def _uuids(rng, n):
+    raw = rng.bytes(16 * n)
+    return [str(uuid.UUID(bytes=raw[i:i + 16], version=4)) for i in range(0, 16 * n, 16)]
+
+
+def _timestamps(rng, n, days_back):
+    # ISO strings with microseconds, like the exported CSVs
+    us = rng.integers(0, days_back * 86_400_000_000, n)
+    return (_ANCHOR.astype("datetime64[us]") - us.astype("timedelta64[us]")).astype(str)
+
+
+def _repeat(uids, counts):
+    return np.repeat(np.asarray(uids, dtype=object), counts)
+
+
+def _gen_pilot_user(rng, uids, days):
+    n = len(uids)
+    height = rng.normal(170, 12, n).round()
+    weight = rng.normal(70, 15, n).clip(35, 160).round(1)
+    return pd.DataFrame({
+        "user_id": uids,
+        "first_name": rng.choice(_FIRST, n), "last_name": rng.choice(_LAST, n),
+        "age": rng.integers(25, 75, n), "sex": rng.choice(["Male", "Female", "Other"], n, p=[0.48, 0.48, 0.04]),
+        "height_cm": height, "weight_kg": weight, "bmi": (weight / (height / 100) ** 2).round(2),
+        "consent_flag": rng.random(n) < 0.95,
+    })
+
+
+def _gen_labs(rng, uids, days):
+    n_draws = rng.integers(1, 4, len(uids))
+    draw_user = _repeat(uids, n_draws)
+    draw_time = _timestamps(rng, len(draw_user), 730)
+    k = len(_LAB_TESTS)
+    # per-user offset so a user's draws are correlated
+    offset = np.repeat(rng.normal(0, 0.6, len(uids)), n_draws)
+    means = np.array([t[5] for t in _LAB_TESTS])
+    sds = np.array([t[6] for t in _LAB_TESTS])
+    values = (means + sds * (offset[:, None] + rng.normal(0, 0.8, (len(draw_user), k)))).clip(0.01).round(2)
+    rows = len(draw_user) * k
+    test = np.tile(np.arange(k), len(draw_user))
+    return pd.DataFrame({
+        "user_id": np.repeat(draw_user, k), "lab_result_id": _uuids(rng, rows),
+        "loinc_code": np.array([t[0] for t in _LAB_TESTS])[test], "test_name": np.array([t[1] for t in _LAB_TESTS])[test],
+        "value": values.ravel(), "unit": np.array([t[2] for t in _LAB_TESTS])[test],
+        "ref_low": np.array([t[3] for t in _LAB_TESTS])[test], "ref_high": np.array([t[4] for t in _LAB_TESTS])[test],
+        "collected_at": np.repeat(draw_time, k),
+        "provider": np.repeat(rng.choice(_PROVIDERS, len(draw_user)), k),
+    })
+
+
+def _gen_wearable(rng, uids, days):
+    n = len(uids)
+    base = {  # per-user baselines plus day-to-day noise
+        "resting_hr": (rng.normal(63, 9, n), 5, 0),
+        "hrv_rmssd": (rng.normal(58, 18, n), 12, 0),
+        "steps": (rng.normal(9800, 2500, n), 2500, 0),
+        "sleep_hours": (rng.normal(7.5, 0.7, n), 0.8, 2),
+        "sleep_efficiency": (rng.normal(88.5, 4, n), 3, 2),
+        "spo2_avg": (rng.normal(97, 0.7, n), 0.6, 2),
+    }
+    cols = {"user_id": _repeat(uids, days),
+            "date": np.tile((_ANCHOR - np.arange(days).astype("timedelta64[D]")).astype(str), n)}
+    for name, (mu, sd, decimals) in base.items():
+        v = np.repeat(mu, days) + rng.normal(0, sd, n * days)
+        cols[name] = v.round(decimals).astype(np.int64) if decimals == 0 else v.round(decimals)
+    cols["steps"] = cols["steps"].clip(0)
+    cols["sleep_efficiency"] = cols["sleep_efficiency"].clip(60, 99)
+    cols["spo2_avg"] = cols["spo2_avg"].clip(90, 99.5)
+    return pd.DataFrame(cols)
+
+
+def _gen_microbiome(rng, uids, days):
+    n, k = len(uids), len(_TAXA)
+    abundance = rng.dirichlet(np.ones(k) * 2, n).round(5)
+    samples = np.repeat(np.asarray(_uuids(rng, n), dtype=object), k)
+    return pd.DataFrame({
+        "user_id": _repeat(uids, k), "sample_id": samples, "taxa_level": "genus",
+        "taxa_name": np.tile(_TAXA, n), "relative_abundance": abundance.ravel(),
+        "collected_at": np.repeat(_timestamps(rng, n, 365), k),
+    })
+
+
+def _gen_metabolomics(rng, uids, days):
+    n, k = len(uids), len(_METABOLITES)
+    idx = np.tile(np.arange(k), n)
+    conc = np.array([m[2] for m in _METABOLITES])[idx] + np.array([m[3] for m in _METABOLITES])[idx] * rng.normal(0, 1, n * k)
+    return pd.DataFrame({
+        "user_id": _repeat(uids, k), "sample_id": np.repeat(np.asarray(_uuids(rng, n), dtype=object), k),
+        "metabolite_id": np.array([m[0] for m in _METABOLITES])[idx],
+        "metabolite_name": np.array([m[1] for m in _METABOLITES])[idx],
+        "concentration": conc.clip(1).round(3), "unit": "µM", "platform": "Metabolon DiscoverHT",
+        "batch_id": np.repeat(rng.choice(["B041", "B042", "B043"], n), k),
+        "collected_at": np.repeat(_timestamps(rng, n, 365), k),
+    })
+
+
+def _gen_genomics(rng, uids, days):
+    n = len(uids)
+    return pd.DataFrame({
+        "user_id": uids, "file_id": _uuids(rng, n),
+        "apoe4_present": (rng.random(n) < 0.14).astype(int), "mthfr_variant": rng.choice([0, 1, 2], n, p=[0.55, 0.33, 0.12]),
+        "polygenic_score_cvd": rng.normal(1.0, 0.44, n).round(4), "annotation_version": "ClinVar-20230101",
+        "processed_at": _timestamps(rng, n, 365),
+    })
+
+
+def _gen_meds(rng, uids, days):
+    counts = rng.poisson(2.0, len(uids))
+    n = int(counts.sum())
+    pick = rng.integers(0, len(_MEDS), n)
+    start = _ANCHOR - rng.integers(30, 1500, n).astype("timedelta64[D]")
+    ended = rng.random(n) < 0.1
+    end = np.where(ended, (start + rng.integers(14, 365, n).astype("timedelta64[D]")).astype(str), "")
+    return pd.DataFrame({
+        "user_id": _repeat(uids, counts), "med_id": _uuids(rng, n),
+        "name": [_MEDS[i][0] for i in pick], "rxnorm_code": [_MEDS[i][1] or "" for i in pick],
+        "dose": [_MEDS[i][2][j % len(_MEDS[i][2])] for i, j in zip(pick, rng.integers(0, 2, n))],
+        "frequency": rng.choice(_FREQUENCIES, n), "start_date": start.astype(str), "end_date": end,
+        "source": "user_upload",
+    })
+
+
+def _gen_surveys(rng, uids, days):
+    counts = rng.poisson(12, len(uids))
+    n = int(counts.sum())
+    return pd.DataFrame({
+        "user_id": _repeat(uids, counts), "timestamp": _timestamps(rng, n, 30),
+        "survey_id": "daily_check_in_v1", "question_id": rng.choice(_QUESTIONS, n),
+        "answer": rng.integers(1, 6, n),
+    })
+
+
+_GENERATORS = {
+    "pilot_user_data.csv": _gen_pilot_user,
+    "structured_lab_results.csv": _gen_labs,
+    "wearable_daily_aggregates.csv": _gen_wearable,
+    "microbiome_summary.csv": _gen_microbiome,
+    "metabolomics_summary.csv": _gen_metabolomics,
+    "genomic_summary.csv": _gen_genomics,
+    "medication_history.csv": _gen_meds,
+    "surveys_adherence_logs.csv": _gen_surveys,
+}
+
+
+def generate_catalog(rng, rows):
+    themes = rng.choice(_CATALOG_THEMES, (rows, 2))
+    lengths = rng.integers(5, 40, rows)
+    return pd.DataFrame({
+        "name": [f"PEP-{i:05d}" for i in range(rows)],
+        "sequence": ["".join(rng.choice(_AMINO, k)) for k in lengths],
+        "length": lengths,
+        "indication": [f"{a}; {b}" for a, b in themes],
+        "function": rng.choice(_CATALOG_THEMES, rows),
+        "mechanism": rng.choice(_MECHANISMS, rows),
+        "description": [f"Synthetic peptide studied for {a} and {b}." for a, b in themes],
+        "source": rng.choice(["literature", "patent", "database"], rows),
+    })
+
+
+def generate(out_dir, users, days=90, catalog_rows=58583, seed=0, chunk_users=20000, log=sys.stderr):
+    """Write ``out_dir``/data/*.csv and ``out_dir``/main.xlsx; returns rows written per file."""
+    rng = np.random.default_rng(seed)
+    data_dir = os.path.join(out_dir, "data")
+    os.makedirs(data_dir, exist_ok=True)
+    rows = {name: 0 for name in _GENERATORS}
+    for start in range(0, users, chunk_users):
+        uids = _uuids(rng, min(chunk_users, users - start))
+        for name, gen in _GENERATORS.items():
+            df = gen(rng, uids, days)
+            df.to_csv(os.path.join(data_dir, name), mode="w" if start == 0 else "a", header=start == 0, index=False)
+            rows[name] += len(df)
+        print(f"  {start + len(uids)}/{users} users", file=log)
+    if catalog_rows:
+        generate_catalog(rng, catalog_rows).to_excel(os.path.join(out_dir, "main.xlsx"), index=False)
+        rows["main.xlsx"] = catalog_rows
+    return rows
+
+
+# ---- Scenarios ----
+_STUB_TEXT = "## 1. SUPPLEMENT STACK\n- Vitamin D3\n## 2. PEPTIDES\n- none\n(informational only, not medical advice)"
+
+
+class _StubLLM:
+    """Stands in for the OpenAI client: answers instantly with canned text."""
+
+    def __init__(self):
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **kwargs):
+        self.calls += 1
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=_STUB_TEXT))])
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def _time(fn, args_list):
+    times = []
+    for args in args_list:
+        t = time.perf_counter()
+        fn(*args)
+        times.append(time.perf_counter() - t)
+    return times
+
+
+def _summary(times):
+    ms = sorted(t * 1000 for t in times)
+    return {
+        "n": len(ms),
+        "p50_ms": round(statistics.median(ms), 3),
+        "p95_ms": round(ms[min(len(ms) - 1, int(round(0.95 * (len(ms) - 1))))], 3),
+        "mean_ms": round(statistics.fmean(ms), 3),
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+SCENARIOS = ["load_cold", "load_warm", "extract_user_profile", "assemble_user_dataframe",
+             "rule_based_recommendations", "build_recommendations"]
+
+
+def run(data_root=".", samples=200, repeats=3, seed=0, scenarios=None, log=sys.stderr):
+    """Time each scenario against the dataset at ``data_root`` (holding data/ and main.xlsx)."""
+    scenarios = scenarios or SCENARIOS
+    os.chdir(data_root)
+    # no API calls and no response cache: the stub is hit every time
+    os.environ["LLM_CACHE_PATH"] = ""
+    import rec_engine
+    from rec_engine import (
+        BUNDLE_CACHE, DataBundle, assemble_user_dataframe, build_recommendations, extract_user_profile,
+        rule_based_recommendations,
+    )
+
+    results = {}
+
+    def record(name, times):
+        results[name] = _summary(times)
+        r = results[name]
+        print(f"  {name:<28} p50 {r['p50_ms']:>10.3f} ms  p95 {r['p95_ms']:>10.3f} ms  "
+              f"peak RSS {r['peak_rss_mb']:>8.1f} MB", file=log)
+
+    if "load_cold" in scenarios:
+        # includes the catalog and its index, which a bundle otherwise reads on first use
+        record("load_cold", _time(lambda: DataBundle.load(use_cache=False).catalog_index, [()] * repeats))
+    BUNDLE_CACHE.clear()
+    bundle = DataBundle.load()
+    if "load_warm" in scenarios:
+        record("load_warm", _time(DataBundle.load, [()] * max(repeats, 20)))
+
+    users = sorted(bundle.all_users, key=str)
+    rng = np.random.default_rng(seed)
+    sample = [users[i] for i in rng.choice(len(users), min(samples, len(users)), replace=False)]
+    if "extract_user_profile" in scenarios:
+        record("extract_user_profile", _time(lambda u: extract_user_profile(bundle, u), [(u,) for u in sample]))
+    if "assemble_user_dataframe" in scenarios:
+        record("assemble_user_dataframe", _time(lambda u: assemble_user_dataframe(bundle, u), [(u,) for u in sample]))
+    if "rule_based_recommendations" in scenarios:
+        profiles = [(extract_user_profile(bundle, u),) for u in sample]
+        record("rule_based_recommendations",
+               _time(lambda p: rule_based_recommendations(p, bundle.main, bundle.catalog_index), profiles))
+    if "build_recommendations" in scenarios:
+        stub = _StubLLM()
+        record("build_recommendations", _time(lambda u: build_recommendations(u, client=stub), [(u,) for u in sample]))
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git_rev": _git_rev(),
+            "python": platform.python_version(), "pandas": pd.__version__, "numpy": np.__version__,
+            "machine": platform.machine(), "cpus": os.cpu_count(),
+            "data_root": os.path.abspath("."), "samples": len(sample), "seed": seed,
+        },
+        "dataset": {name: (0 if getattr(bundle, name) is None else len(getattr(bundle, name)))
+                    for name in ["main"] + list(rec_engine._USER_TABLES)},
+        "table_memory_mb": {name: round(n / 1e6, 2) for name, n in bundle.memory_usage().items()},
+        "scenarios": results,
+    }
+
+
+def _git_rev():
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.run(["git", "-C", here, "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+# ---- Startup ----
+_HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _import_times(module, cwd, env):
+    """{module: (nesting depth, cumulative microseconds)} from ``python -X importtime -c 'import <module>'``."""
+    code = f"import sys; sys.path.insert(0, {_HERE!r}); import {module}"
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                          cwd=cwd, env=env, capture_output=True, text=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        times[name.strip()] = ((len(name) - len(name.lstrip()) - 1) // 2, int(cumulative_us))
+    return times
+
+
+def _wall_ms(cmd, cwd, env, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(cmd, cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return round(statistics.median(times), 1)
+
+
+def startup(data_root=".", user_id=None, repeats=5, budget_ms=None, log=sys.stderr):
+    """Import time of agent.py / rec_engine and wall time of short agent.py invocations."""
+    # rule-based path only: no key, no response cache
+    env = dict(os.environ, OPENAI_API_KEY="", LLM_CACHE_PATH="")
+    agent_imports = _import_times("agent", data_root, env)
+    engine_imports = _import_times("rec_engine", data_root, env)
+    result = {
+        "import_ms": {"agent": round(agent_imports["agent"][1] / 1000, 1),
+                      "rec_engine": round(engine_imports["rec_engine"][1] / 1000, 1)},
+        # rec_engine's own imports, largest first
+        "rec_engine_imports_ms": dict([(name, round(us / 1000, 1)) for name, (depth, us) in sorted(
+            engine_imports.items(), key=lambda kv: -kv[1][1]) if depth == 1][:8]),
+        "wall_ms": {"help": _wall_ms([sys.executable, os.path.join(_HERE, "agent.py"), "--help"],
+                                     data_root, env, repeats)},
+    }
+    if user_id is None:
+        try:
+            with open(os.path.join(data_root, "data", "pilot_user_data.csv")) as fh:
+                fh.readline()
+                user_id = fh.readline().split(",")[0].strip() or None
+        except OSError:
+            pass
+    if user_id:
+        result["wall_ms"]["user"] = _wall_ms([sys.executable, os.path.join(_HERE, "agent.py"), "-u", user_id],
+                                             data_root, env, repeats)
+    if budget_ms is not None:
+        result["budget_ms"] = budget_ms
+        # agent.py imports rec_engine lazily, so its own import cannot regress in a way that matters
+        result["within_budget"] = result["import_ms"]["rec_engine"] <= budget_ms
+    print(f"  import agent {result['import_ms']['agent']:.1f} ms, rec_engine {result['import_ms']['rec_engine']:.1f} ms; "
+          f"wall {', '.join(f'{k} {v:.0f} ms' for k, v in result['wall_ms'].items())}", file=log)
+    return result
+
+
+# ---- Ingest check ----
+def _append_csv(path, rows, newline=True):
+    text = rows.to_csv(header=False, index=False, lineterminator="\n")
+    with open(path, "a") as fh:
+        fh.write(text if newline else text.rstrip("\n"))
+
+
+def _touch_later(path):
+    # same-size rewrites must still read as changed, whatever the mtime resolution
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+
+
+def _bundle_diff(got, want, engine):
+    """What differs between a cache-refreshed bundle and a from-scratch load (empty when equal)."""
+    problems = []
+    for name in engine._USER_TABLES:
+        a, b = getattr(got, name), getattr(want, name)
+        if a is None or b is None:
+            if (a is None) != (b is None):
+                problems.append(f"{name}: loaded on one side only")
+            continue
+        for c in b.columns:
+            da, db = a[c].dtype, b[c].dtype
+            if da != db and not (isinstance(da, pd.CategoricalDtype) and isinstance(db, pd.CategoricalDtype)):
+                problems.append(f"{name}.{c}: dtype {da} vs full reload {db}")
+        try:
+            # appended categories land after the existing ones; only the values must agree
+            pd.testing.assert_frame_equal(a, b, check_categorical=False, check_dtype=False)
+        except AssertionError as exc:
+            problems.append(f"{name}: values differ ({str(exc).splitlines()[0]})")
+        ia, ib = got.row_index.get(name, {}), want.row_index.get(name, {})
+        if ia.keys() != ib.keys() or any(not np.array_equal(ia[u], ib[u]) for u in ib):
+            problems.append(f"{name}: per-user row index differs")
+    if got.all_users != want.all_users:
+        problems.append("all_users differs")
+    la, lb = got.lab_matrix, want.lab_matrix
+    if (la is None) != (lb is None):
+        problems.append("lab matrix: built on one side only")
+    elif la is not None:
+        for field in ("users", "markers", "loinc", "units", "lookup"):
+            if getattr(la, field) != getattr(lb, field):
+                problems.append(f"lab matrix: {field} differs")
+        if list(la.users) == list(lb.users) and la.markers == lb.markers:
+            for field in ("values", "ref_low", "ref_high"):
+                if not np.array_equal(getattr(la, field), getattr(lb, field), equal_nan=True):
+                    problems.append(f"lab matrix: {field} differs")
+    wa, wb = got.wearable_windows, want.wearable_windows
+    if (wa is None) != (wb is None) or (wa is not None and wa.users.keys() != wb.users.keys()):
+        problems.append("wearable windows: users differ")
+    elif wa is not None:
+        ra = np.array([wa.users[u] for u in wb.users], dtype=np.int64)
+        rb = np.array(list(wb.users.values()), dtype=np.int64)
+        for field in ("sum", "count", "min", "max"):
+            if not np.allclose(getattr(wa, field)[ra], getattr(wb, field)[rb], equal_nan=True):
+                problems.append(f"wearable windows: {field} differs")
+    users = sorted(want.all_users, key=str)
+    if list(engine.build_recommendations_batch(users, workers=1, bundle=got)) != \
+            list(engine.build_recommendations_batch(users, workers=1, bundle=want)):
+        problems.append("batch recommendations differ")
+    return problems
+
+
+def ingest_check(data_root=".", rows=40, log=sys.stderr):
+    """Refresh a copy of the data through the append-only cache and compare it with a full reload.
+
+    Covers appended rows with new users and category values, lab results newer and
+    older than the stored ones (the lab matrix is updated in place), a partial last line,
+    a tail that changes a column's type, an in-place rewrite and a truncation, and
+    checks that an append leaves the bundle it replaced untouched.
+    """
+    import shutil
+    import tempfile
+    import rec_engine as engine
+
+    work = tempfile.mkdtemp(prefix="ingest-check-")
+    try:
+        data = os.path.join(work, "data")
+        shutil.copytree(os.path.join(data_root, "data"), data,
+                        ignore=shutil.ignore_patterns(engine._SNAPSHOT_DIR))
+        catalog = os.path.join(work, "main.xlsx")          # absent: the catalog is not under test
+        paths = {name: path for name, path in engine._table_paths(data, catalog).items()
+                 if name != "main" and os.path.exists(path)}
+        cache = engine.BundleCache()
+        results = {}
+
+        def check(label):
+            got = cache.get(data, catalog)
+            results[label] = _bundle_diff(got, engine.DataBundle.load(data, catalog, use_cache=False), engine) or "ok"
+            print(f"  {label}: {'ok' if results[label] == 'ok' else 'FAIL'}", file=log)
+            return got
+
+        def source_rows(name, n):
+            return pd.read_csv(paths[name], dtype=str, keep_default_na=False).tail(n)
+
+        base = check("initial")
+        lengths = {name: len(getattr(base, name)) for name in paths}
+        index_sizes = {name: sum(map(len, base.row_index[name].values())) for name in base.row_index}
+
+        # rows for existing users plus new users, with unseen category values
+        for i, name in enumerate(paths):
+            tail = source_rows(name, rows)
+            tail.iloc[: rows // 2, 0] = [f"ingest-check-{i}-{j % 3}" for j in range(rows // 2)]
+            if "test_name" in tail.columns:
+                tail.iloc[0, tail.columns.get_loc("test_name")] = "Ingest Check Marker"
+            _append_csv(paths[name], tail)
+        after = check("append")
+        if any(len(getattr(base, name)) != n for name, n in lengths.items()) or \
+                any(sum(map(len, base.row_index[name].values())) != n for name, n in index_sizes.items()):
+            results["append"] = (results["append"] if results["append"] != "ok" else []) + \
+                ["the replaced bundle was modified by the append"]
+        if cache.appends == 0:
+            results["append"] = (results["append"] if results["append"] != "ok" else []) + \
+                ["no table was extended in place"]
+
+        if "labs" in paths:
+            # results newer and older than the stored ones, a tie, and a marker not seen before
+            tail = source_rows("labs", rows)
+            when = pd.to_datetime(tail["collected_at"], errors="coerce")
+            shift = np.resize(np.array([30, -3650, 0], dtype="timedelta64[D]"), len(tail))
+            tail["collected_at"] = (when + shift).dt.strftime("%Y-%m-%dT%H:%M:%S").fillna("")
+            tail["value"] = (pd.to_numeric(tail["value"], errors="coerce") * 1.5).round(2).astype(str)
+            tail.iloc[-1, tail.columns.get_loc("test_name")] = "Ingest Check Late Marker"
+            _append_csv(paths["labs"], tail)
+            labs_before = after.lab_matrix
+            after = check("labs append")
+            if labs_before is not None and after.lab_matrix is not None and \
+                    np.shares_memory(after.lab_matrix.values, labs_before.values):
+                results["labs append"] = (results["labs append"] if results["labs append"] != "ok" else []) + \
+                    ["lab matrix shared with the replaced bundle"]
+
+        if "surveys" in paths:
+            # a half-written line is held back until its newline arrives
+            tail = source_rows("surveys", 1)
+            _append_csv(paths["surveys"], tail, newline=False)
+            partial = cache.get(data, catalog)
+            if len(partial.surveys) != len(after.surveys):
+                results["partial line"] = ["partial last line was ingested"]
+            with open(paths["surveys"], "a") as fh:
+                fh.write("\n")
+            if "partial line" not in results:
+                check("partial line")
+
+            # text in a numeric column: the cache must end up typed like a full parse
+            tail = source_rows("surveys", 2)
+            tail["answer"] = "not sure"
+            _append_csv(paths["surveys"], tail)
+            check("type change")
+
+        name = "labs" if "labs" in paths else next(iter(paths))
+
+        def overwrite_byte(pos):
+            # same size, one byte changed before the cached offset
+            with open(paths[name], "r+b") as fh:
+                fh.seek(pos)
+                old = fh.read(1)
+                fh.seek(pos)
+                fh.write(b"x" if old != b"x" else b"y")
+            _touch_later(paths[name])
+
+        with open(paths[name], "rb") as fh:
+            fh.readline()
+            overwrite_byte(fh.tell())                        # first data row
+        check("rewrite head")
+        overwrite_byte(os.path.getsize(paths[name]) - 10)    # inside the last row
+        check("rewrite tail")
+
+        with open(paths[name], "rb") as fh:
+            lines = fh.readlines()
+        with open(paths[name], "wb") as fh:
+            fh.writelines(lines[:-rows])
+        _touch_later(paths[name])
+        check("truncate")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    return {"checks": results, "ok": all(v == "ok" for v in results.values())}
+
+
+def compare(before, after, out=sys.stdout):
+    print(f"{'scenario':<28} {'p50 before':>12} {'p50 after':>12} {'x':>7} {'p95 before':>12} {'p95 after':>12} {'x':>7}", file=out)
+    for name, b in before["scenarios"].items():
+        a = after["scenarios"].get(name)
+        if a is None:
+            continue
+        r50 = b["p50_ms"] / a["p50_ms"] if a["p50_ms"] else float("inf")
+        r95 = b["p95_ms"] / a["p95_ms"] if a["p95_ms"] else float("inf")
+        print(f"{name:<28} {b['p50_ms']:>12.3f} {a['p50_ms']:>12.3f} {r50:>7.2f} "
+              f"{b['p95_ms']:>12.3f} {a['p95_ms']:>12.3f} {r95:>7.2f}", file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for the recommendation pipeline")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    gen = sub.add_parser("generate", help="Write a synthetic dataset (data/*.csv + main.xlsx)")
+    gen.add_argument("--out", default="bench_data", help="Output directory (default: bench_data)")
+    gen.add_argument("--users", type=int, default=10000)
+    gen.add_argument("--days", type=int, default=90, help="Wearable days per user")
+    gen.add_argument("--catalog-rows", type=int, default=58583, help="Peptide catalog rows in main.xlsx (0 to skip)")
+    gen.add_argument("--seed", type=int, default=0)
+    gen.add_argument("--chunk-users", type=int, default=20000, help="Users generated per chunk (bounds memory)")
+
+    rn = sub.add_parser("run", help="Time the pipeline scenarios and print JSON results")
+    rn.add_argument("--data", default=".", help="Directory holding data/ and main.xlsx (default: the repo's own)")
+    rn.add_argument("--samples", type=int, default=200, help="Users sampled for the per-user scenarios")
+    rn.add_argument("--repeats", type=int, default=3, help="Cold loads to time")
+    rn.add_argument("--seed", type=int, default=0)
+    rn.add_argument("--scenarios", help=f"Comma-separated subset of: {','.join(SCENARIOS)}")
+    rn.add_argument("--output", "-o", help="Write the JSON results here instead of stdout")
+
+    cmp = sub.add_parser("compare", help="Compare two `run` result files")
+    cmp.add_argument("before")
+    cmp.add_argument("after")
+
+    st = sub.add_parser("startup", help="Measure agent.py import and one-shot invocation time")
+    st.add_argument("--data", default=".", help="Directory holding data/ and main.xlsx (default: the repo's own)")
+    st.add_argument("--user", help="USERID for the timed `agent.py -u` run (default: first in pilot_user_data.csv)")
+    st.add_argument("--repeats", type=int, default=5)
+    st.add_argument("--budget-ms", type=float, help="Exit with status 1 if importing rec_engine takes longer")
+
+    ic = sub.add_parser("ingest-check", help="Check append-only cache refreshes against full reloads")
+    ic.add_argument("--data", default=".", help="Directory holding data/ (copied; the original is not touched)")
+    ic.add_argument("--rows", type=int, default=40, help="Rows appended per table")
+    args = parser.parse_args()
+
+    if args.command == "generate":
+        start = time.perf_counter()
+        rows = generate(args.out, args.users, args.days, args.catalog_rows, args.seed, args.chunk_users)
+        print(json.dumps(rows, indent=2))
+        print(f"generated in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+    elif args.command == "run":
+        output = os.path.abspath(args.output) if args.output else None
+        scenarios = args.scenarios.split(",") if args.scenarios else None
+        unknown = set(scenarios or []) - set(SCENARIOS)
+        if unknown:
+            parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+        result = run(args.data, args.samples, args.repeats, args.seed, scenarios)
+        if output:
+            with open(output, "w") as fh:
+                json.dump(result, fh, indent=2)
+        else:
+            print(json.dumps(result, indent=2))
+    elif args.command == "startup":
+        result = startup(args.data, args.user, args.repeats, args.budget_ms)
+        print(json.dumps(result, indent=2))
+        if not result.get("within_budget", True):
+            sys.exit(1)
+    elif args.command == "ingest-check":
+        result = ingest_check(args.data, args.rows)
+        print(json.dumps(result, indent=2))
+        if not result["ok"]:
+            sys.exit(1)
+    else:
+        with open(args.before) as fh:
+            before = json.load(fh)
+        with open(args.after) as fh:
+            after = json.load(fh)
+        compare(before, after)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""Lightweight per-stage timing and counters for the recommendation pipeline.
+
+``span(name)`` times a block and ``count(name, n)`` bumps a counter. Both feed the
+process-wide ``METRICS`` registry and, while a ``trace()`` is active in the
+current context, that request's own ``Trace`` (what build_recommendations returns
+as its ``timings`` field). Finished traces are handed to the registered
+exporters, e.g. ``JsonLogExporter``; ``METRICS.write_prometheus(path)`` dumps the
+running totals in the Prometheus text format.
+"""
+import contextvars
+import json
+import os
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+
+class Trace:
+    def __init__(self, name: str, **labels: Any):
+        self.name = name
+        self.labels = labels
+        self.spans: Dict[str, float] = {}     # stage -> milliseconds (summed if entered repeatedly)
+        self.counters: Dict[str, int] = {}
+        self.errors: List[str] = []
+        self.started = time.time()
+        self.total_ms: Optional[float] = None
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "total_ms": None if self.total_ms is None else round(self.total_ms, 3),
+            "spans_ms": {k: round(v, 3) for k, v in self.spans.items()},
+            "counters": dict(self.counters),
+            "errors": list(self.errors),
+        }
+
+
+class Metrics:
+    """Process-wide totals: span count/seconds per stage and event counters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.span_count: Dict[str, int] = {}
+        self.span_seconds: Dict[str, float] = {}
+        self.counters: Dict[str, int] = {}
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.span_count[name] = self.span_count.get(name, 0) + 1
+            self.span_seconds[name] = self.span_seconds.get(name, 0.0) + seconds
+
+    def inc(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"spans": {k: {"count": self.span_count[k], "seconds": self.span_seconds[k]} for k in self.span_count},
+                    "counters": dict(self.counters)}
+
+    def reset(self) -> None:
+        with self._lock:
+            self.span_count.clear()
+            self.span_seconds.clear()
+            self.counters.clear()
+
+    def prometheus_text(self, prefix: str = "rec_engine") -> str:
+        snap = self.snapshot()
+
+        def label(v):
+            return re.sub(r'(["\\])', r"\\\1", v)
+
+        lines = [f"# HELP {prefix}_stage_seconds Time spent per pipeline stage.",
+                 f"# TYPE {prefix}_stage_seconds summary"]
+        for name, s in sorted(snap["spans"].items()):
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{label(name)}"}} {s["seconds"]:.6f}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{label(name)}"}} {s["count"]}')
+        lines += [f"# HELP {prefix}_events_total Pipeline event counters (cache hits, rows scanned, errors).",
+                  f"# TYPE {prefix}_events_total counter"]
+        for name, n in sorted(snap["counters"].items()):
+            lines.append(f'{prefix}_events_total{{event="{label(name)}"}} {n}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path: str, prefix: str = "rec_engine") -> None:
+        # written beside the target and renamed, so a scraper (node_exporter textfile) never sees half a file
+        tmp = f"{path}.tmp-{os.getpid()}"
+        with open(tmp, "w") as fh:
+            fh.write(self.prometheus_text(prefix))
+        os.replace(tmp, path)
+
+
+METRICS = Metrics()
+_CURRENT: contextvars.ContextVar = contextvars.ContextVar("rec_engine_trace", default=None)
+_EXPORTERS: List[Callable[[Trace], None]] = []
+
+
+def add_exporter(fn: Callable[[Trace], None]) -> None:
+    """Call ``fn(trace)`` for every finished trace (exceptions in ``fn`` are ignored)."""
+    _EXPORTERS.append(fn)
+
+
+def remove_exporter(fn: Callable[[Trace], None]) -> None:
+    if fn in _EXPORTERS:
+        _EXPORTERS.remove(fn)
+
+
+def current() -> Optional[Trace]:
+    return _CURRENT.get()
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        METRICS.observe(name, elapsed)
+        tr = _CURRENT.get()
+        if tr is not None:
+            tr.spans[name] = tr.spans.get(name, 0.0) + elapsed * 1000
+
+
+def count(name: str, n: int = 1) -> None:
+    METRICS.inc(name, n)
+    tr = _CURRENT.get()
+    if tr is not None:
+        tr.counters[name] = tr.counters.get(name, 0) + n
+
+
+def record_error(stage: str, exc: BaseException) -> None:
+    """Note an exception a stage swallowed (e.g. to fall back) so it is not lost silently."""
+    count(f"errors.{stage}")
+    tr = _CURRENT.get()
+    if tr is not None:
+        tr.errors.append(f"{stage}: {type(exc).__name__}: {exc}")
+
+
+@contextmanager
+def trace(name: str, **labels: Any) -> Iterator[Trace]:
+    """Collect the spans/counters of one request; exported when the block exits."""
+    tr = Trace(name, **labels)
+    token = _CURRENT.set(tr)
+    start = time.perf_counter()
+    try:
+        yield tr
+    finally:
+        elapsed = time.perf_counter() - start
+        tr.total_ms = elapsed * 1000
+        _CURRENT.reset(token)
+        METRICS.observe(name, elapsed)
+        for fn in list(_EXPORTERS):
+            try:
+                fn(tr)
+            except Exception:
+                pass
+
+
+class JsonLogExporter:
+    """Appends one JSON line per finished trace to a file path or open stream."""
+
+    def __init__(self, target: Any = sys.stderr):
+        self._lock = threading.Lock()
+        self._own = isinstance(target, str)
+        self._fh = open(target, "a") if self._own else target
+
+    def __call__(self, tr: Trace) -> None:
+        line = json.dumps({"ts": round(tr.started, 3), "trace": tr.name, **tr.labels, **tr.as_dict()}, default=str)
+        with self._lock:
+            self._fh.write(line + "\n")
+            self._fh.flush()
+
+    def close(self) -> None:
+        if self._own:
+            self._fh.close()
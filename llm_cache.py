@@ -0,0 +1,93 @@
+"""Persistent SQLite cache for LLM recommendation responses.
+
+Entries are keyed by a SHA-256 of the canonical JSON of everything that
+determines a completion (user context, system prompt, model, temperature), so a
+repeat request for an unchanged profile is answered from disk. Entries expire
+after ``ttl_seconds`` and the least recently used ones are evicted once the
+cache holds more than ``max_entries``.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional
+
+DEFAULT_PATH = os.path.join(".cache", "llm_responses.sqlite3")
+
+
+def cache_key(user_context: Any, system_prompt: str, model: str, temperature: float) -> str:
+    """Stable fingerprint of a request; dict key order and whitespace do not matter."""
+    payload = json.dumps(
+        {"context": user_context, "system": system_prompt, "model": model, "temperature": temperature},
+        sort_keys=True, separators=(",", ":"), default=str,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    def __init__(self, path: str = DEFAULT_PATH, ttl_seconds: Optional[float] = 7 * 24 * 3600,
+                 max_entries: int = 5000):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, model TEXT, response TEXT NOT NULL,"
+                " created_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses(last_access)")
+
+    def _connect(self) -> sqlite3.Connection:
+        # one short-lived connection per operation keeps this safe across threads and processes
+        return sqlite3.connect(self.path, timeout=10)
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT response, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl_seconds is not None and now - row[1] > self.ttl_seconds:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.expired += 1
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, response: str, model: Optional[str] = None) -> None:
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model, response, created_at, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, model, response, now, now),
+            )
+            (count,) = conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+            excess = count - self.max_entries
+            if excess > 0:
+                conn.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_access LIMIT ?)",
+                    (excess,),
+                )
+                self.evictions += excess
+
+    def clear(self) -> None:
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM responses")
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock, self._connect() as conn:
+            (count,) = conn.execute("SELECT COUNT(*) FROM responses").fetchone()
+            return {"hits": self.hits, "misses": self.misses, "expired": self.expired,
+                    "evictions": self.evictions, "entries": count}
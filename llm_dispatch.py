@@ -0,0 +1,194 @@
+"""Asyncio dispatcher for LLM recommendations across many users.
+
+One pooled ``AsyncOpenAI`` client is shared by every request. In-flight calls
+are bounded by a semaphore and paced by a token bucket, each attempt has its own
+timeout, and transient failures (timeouts, connection errors, 408/409/429 and 5xx)
+are retried with jittered exponential backoff; anything else fails at once. For every
+user the rule-based recommendations are computed while the LLM call is still
+pending, so a failed or timed-out call falls back without extra latency.
+
+Point ``base_url`` (or OPENAI_BASE_URL) at any OpenAI-compatible server, e.g. a
+local fake, to exercise it without the real API.
+"""
+import asyncio
+import os
+import random
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import instrument
+import rec_engine
+from rec_engine import (
+    LLM_MODEL, LLM_TEMPERATURE, DataBundle, UserView, build_llm_context, build_llm_messages,
+    cohort_user_ids, compute_signals, get_llm_cache, llm_cache_key, rule_based_recommendations,
+)
+
+
+class TokenBucket:
+    """Allows ``rate`` acquisitions per second on average, with bursts up to ``capacity``."""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncLLMDispatcher:
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None, client: Any = None,
+                 max_concurrency: int = 8, requests_per_second: float = 5.0, burst: Optional[float] = None,
+                 timeout: float = 60.0, max_retries: int = 3, backoff_base: float = 0.5, backoff_max: float = 8.0,
+                 use_cache: bool = True):
+        self.api_key = api_key
+        self.base_url = base_url
+        self._client = client
+        self._owns_client = client is None
+        self.max_concurrency = max_concurrency
+        self.bucket = TokenBucket(requests_per_second, burst) if requests_per_second else None
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.cache = get_llm_cache() if use_cache else None
+        self._sem: Optional[asyncio.Semaphore] = None
+        self.stats = {"requests": 0, "retries": 0, "failures": 0, "timeouts": 0, "errors": 0, "cache_hits": 0}
+
+    @property
+    def client(self):
+        # created on first use so the pooled HTTP client binds to the running loop
+        if self._client is None:
+            from openai import AsyncOpenAI
+            self._client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url,
+                                       timeout=self.timeout, max_retries=0)
+        return self._client
+
+    async def aclose(self) -> None:
+        if self._owns_client and self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    async def __aenter__(self) -> "AsyncLLMDispatcher":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.aclose()
+
+    def _backoff(self, attempt: int) -> float:
+        # "full jitter": uniform in [0, min(cap, base * 2^attempt)]
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    @staticmethod
+    def _retryable(exc: BaseException) -> bool:
+        # same classes the OpenAI SDK itself retries; auth, bad request or unknown model will not get better
+        status = getattr(exc, "status_code", None)
+        if status is not None:
+            return status in (408, 409, 429) or status >= 500
+        if isinstance(exc, (asyncio.TimeoutError, ConnectionError)):
+            return True
+        try:
+            from openai import APIConnectionError   # includes APITimeoutError
+        except ImportError:
+            return False
+        return isinstance(exc, APIConnectionError)
+
+    async def complete(self, messages: List[Dict[str, str]]) -> Optional[str]:
+        """One chat completion with pacing, timeout and retries; None if every attempt failed."""
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self.max_concurrency)
+        async with self._sem:
+            for attempt in range(self.max_retries + 1):
+                if attempt:
+                    self.stats["retries"] += 1
+                    await asyncio.sleep(self._backoff(attempt - 1))
+                if self.bucket is not None:
+                    await self.bucket.acquire()
+                self.stats["requests"] += 1
+                try:
+                    resp = await asyncio.wait_for(
+                        self.client.chat.completions.create(model=LLM_MODEL, messages=messages,
+                                                            temperature=LLM_TEMPERATURE),
+                        timeout=self.timeout,
+                    )
+                    text = resp.choices[0].message.content
+                    if text:
+                        return text
+                except Exception as exc:
+                    self.stats["timeouts" if isinstance(exc, asyncio.TimeoutError) else "errors"] += 1
+                    instrument.record_error("llm.dispatch", exc)
+                    if not self._retryable(exc):
+                        break
+            self.stats["failures"] += 1
+            return None
+
+    async def recommend(self, profile: Dict[str, Any], peptide_catalog_sample: List[Dict[str, Any]],
+                        peptide_catalog=None, catalog_index=None) -> Dict[str, Any]:
+        """build_recommendations-shaped result for one user (plus USERID)."""
+        context = build_llm_context(profile, peptide_catalog_sample, catalog_index)
+        key = llm_cache_key(profile, context) if self.cache is not None else None
+        base = {"USERID": profile.get("USERID"), "profile_signals": profile.get("signals", {})}
+        if self.cache is not None:
+            cached = await asyncio.to_thread(self.cache.get, key)
+            if cached is not None:
+                self.stats["cache_hits"] += 1
+                return {**base, "engine": "llm", "recommendations_text": cached}
+
+        llm_task = asyncio.create_task(self.complete(build_llm_messages(profile, context)))
+        # the fallback is ready by the time the LLM answers (or gives up)
+        recs = await asyncio.to_thread(rule_based_recommendations, profile, peptide_catalog, catalog_index)
+        text = await llm_task
+        if text is None:
+            return {**base, "engine": "rule_based", "recommendations": recs}
+        if self.cache is not None:
+            await asyncio.to_thread(self.cache.put, key, text, LLM_MODEL)
+        return {**base, "engine": "llm", "recommendations_text": text}
+
+
+async def recommend_cohort(dispatcher: AsyncLLMDispatcher, user_ids: Optional[List[Any]] = None,
+                           bundle: Optional[DataBundle] = None) -> AsyncIterator[Dict[str, Any]]:
+    """Yield a result per user as soon as it is ready (completion order, not input order)."""
+    if bundle is None:
+        bundle = DataBundle.load()
+    if user_ids is None:
+        user_ids = cohort_user_ids(bundle)
+    records = compute_signals(bundle, user_ids)
+    sample = rec_engine.catalog_prompt_sample(bundle)
+
+    async def one(uid):
+        # each task runs in its own context, so concurrent traces stay separate
+        with instrument.trace("build_recommendations_batch", user_id=str(uid), engine="llm_dispatch"):
+            rec = records.get(uid)
+            if rec is None:
+                return {"USERID": uid, "engine": "no_data", "profile_signals": {},
+                        "message": f"User {uid} not found in any data source."}
+            profile = UserView(bundle, uid, rec)
+            return await dispatcher.recommend(profile, sample, bundle.main, bundle.catalog_index)
+
+    tasks = [asyncio.create_task(one(uid)) for uid in user_ids]
+    try:
+        for fut in asyncio.as_completed(tasks):
+            yield await fut
+    finally:
+        for t in tasks:
+            t.cancel()
+
+
+def dispatcher_from_env(**kwargs) -> Optional[AsyncLLMDispatcher]:
+    """Dispatcher using OPENAI_API_KEY / OPENAI_BASE_URL, or None if neither is configured."""
+    api_key = rec_engine._load_api_key()
+    base_url = kwargs.pop("base_url", None) or os.getenv("OPENAI_BASE_URL")
+    if not api_key and not base_url:
+        return None
+    # OpenAI-compatible local servers usually ignore the key but the SDK requires one
+    return AsyncLLMDispatcher(api_key=api_key or "not-needed", base_url=base_url, **kwargs)
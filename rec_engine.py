@@ -1,32 +1,61 @@
 
+import io
 import os
-from dataclasses import dataclass, field
-from typing import Dict, List, Any, Optional
+import re
+import threading
+import warnings
+from dataclasses import InitVar, dataclass, field
+from functools import lru_cache, partial
+from typing import Callable, Dict, List, Any, Iterator, Optional
+import numpy as np
 import pandas as pd
 from pathlib import Path
 import json
 from datetime import datetime, timedelta
-from dotenv import load_dotenv
 from pathlib import Path
 
+import instrument
+# snapshot and llm_cache are imported where they are used: a one-shot rule-based
+# run should not pay for sqlite3 or the snapshot writer at import time
+
 # ---- Utility: safe read helpers ----
-def _read_csv(path: str) -> Optional[pd.DataFrame]:
+def _parse_dates(df: pd.DataFrame, parse_dates: Optional[List[str]]) -> pd.DataFrame:
+    for c in parse_dates or []:
+        if c in df.columns:
+            df[c] = pd.to_datetime(df[c], format="ISO8601", errors="coerce")
+    return df
+
+def _downcast_ints(df: pd.DataFrame) -> pd.DataFrame:
+    for c, dt in df.dtypes.items():
+        if pd.api.types.is_integer_dtype(dt) and dt.itemsize > 1:
+            df[c] = pd.to_numeric(df[c], downcast="integer")
+    return df
+
+def _parse_csv(source: Any, name: Optional[str] = None) -> pd.DataFrame:
+    """read_csv with the load-time schema of table ``name`` (see _CATEGORY_COLUMNS)."""
+    skip = _SKIP_COLUMNS.get(name, ())
+    df = pd.read_csv(source, dtype={c: "category" for c in _CATEGORY_COLUMNS.get(name, [])},
+                     usecols=lambda c: c not in skip)
+    return _downcast_ints(_parse_dates(df, _DATE_COLUMNS.get(name)))
+
+def _read_csv(path: str, name: Optional[str] = None) -> Optional[pd.DataFrame]:
     try:
         if not Path(path).exists():
             return None
-        df = pd.read_csv(path)
-        return df
-    except Exception:
+        return _parse_csv(path, name)
+    except Exception as exc:
+        instrument.record_error(f"load.{name or Path(path).stem}", exc)
         return None
 
-def _read_excel(path: str) -> Optional[pd.DataFrame]:
+def _read_excel(path: str, name: Optional[str] = None) -> Optional[pd.DataFrame]:
     try:
         if not Path(path).exists():
             return None
         # Read first sheet by default
         df = pd.read_excel(path, sheet_name=0)
         return df
-    except Exception:
+    except Exception as exc:
+        instrument.record_error(f"load.{name or Path(path).stem}", exc)
         return None
 
 def _find_user_key(df: pd.DataFrame) -> Optional[str]:
@@ -39,9 +68,433 @@ def _find_user_key(df: pd.DataFrame) -> Optional[str]:
             return c
     return None
 
+# ---- Source files ----
+# DataBundle field -> CSV file name inside the data directory
+_CSV_FILES = {
+    "pilot_user": "pilot_user_data.csv",
+    "labs": "structured_lab_results.csv",
+    "wearable": "wearable_daily_aggregates.csv",
+    "microbiome": "microbiome_summary.csv",
+    "metabolomics": "metabolomics_summary.csv",
+    "genomics": "genomic_summary.csv",
+    "meds": "medication_history.csv",
+    "surveys": "surveys_adherence_logs.csv",
+}
+
+# Tables that carry per-user rows (everything except the peptide catalog)
+_USER_TABLES = list(_CSV_FILES.keys())
+
+# Timestamp columns parsed to datetime64 at load time
+_DATE_COLUMNS = {
+    "labs": ["collected_at"],
+    "wearable": ["date"],
+    "microbiome": ["collected_at"],
+    "metabolomics": ["collected_at"],
+    "genomics": ["processed_at"],
+    "meds": ["start_date", "end_date"],
+    "surveys": ["timestamp"],
+}
+
+# Load-time schema. Strings that repeat across rows (user ids, test/taxa/metabolite
+# names, units, providers) are read straight into categoricals, integer columns are
+# downcast after parsing, and surrogate row ids that nothing reads are skipped.
+# Floats stay float64 so signal values and prompt cache keys do not shift.
+_CATEGORY_COLUMNS = {
+    "pilot_user": ["user_id", "sex"],
+    "labs": ["user_id", "loinc_code", "test_name", "unit", "provider"],
+    "wearable": ["user_id"],
+    "microbiome": ["user_id", "taxa_level", "taxa_name"],
+    "metabolomics": ["user_id", "metabolite_id", "metabolite_name", "unit", "platform"],
+    "genomics": ["user_id", "annotation_version"],
+    "meds": ["user_id", "name", "dose", "frequency", "source"],
+    "surveys": ["user_id", "survey_id", "question_id"],
+}
+_SKIP_COLUMNS = {
+    "labs": {"lab_result_id"},
+    "microbiome": {"sample_id"},
+    "metabolomics": {"sample_id", "batch_id"},
+    "genomics": {"file_id"},
+}
+
+# Compiled snapshots live next to the CSVs (see snapshot.py / compile_snapshot)
+_SNAPSHOT_DIR = ".snapshot"
+
+def _table_paths(data_dir: str, catalog_path: str) -> Dict[str, str]:
+    paths = {"main": str(catalog_path)}
+    for name, fname in _CSV_FILES.items():
+        paths[name] = str(Path(data_dir) / fname)
+    return paths
+
+def _file_signature(path: str) -> Optional[tuple]:
+    """(absolute path, mtime_ns, size) of a source file, or None if it does not exist."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+def _load_table(name: str, path: str, sig: Optional[tuple], snap_dir: Optional[str] = None) -> Optional[pd.DataFrame]:
+    # Prefer the memory-mapped snapshot while it still matches the source file
+    if snap_dir is not None:
+        import snapshot
+        df = snapshot.read_table(snap_dir, name, sig)
+        if df is not None:
+            return df
+    if name == "main":
+        return _read_excel(path, name)
+    return _read_csv(path, name)
+
+# ---- Lab marker index ----
+# Signal name -> normalized test names / LOINC codes it may appear under in the long lab table
+_LAB_MARKER_ALIASES = {
+    "Vitamin D": ["vitamind", "25ohvitamind", "vitamind25oh", "1989-3"],
+    "Omega-3 Index": ["omega3index"],
+    "LDL": ["ldl", "ldlcholesterol", "13457-7", "2089-1"],
+    "HDL": ["hdl", "hdlcholesterol", "2085-9"],
+    "CRP": ["crp", "hscrp", "creactiveprotein", "30522-7"],
+    "HbA1c": ["hba1c", "a1c", "hemoglobina1c", "4548-4"],
+    "Ferritin": ["ferritin", "2276-4"],
+}
+
+def _norm_marker(name: Any) -> str:
+    return "".join(ch for ch in str(name).lower() if ch.isalnum())
+
+@dataclass
+class LabMatrix:
+    """Latest lab value per (user, marker) from the long-format lab table.
+
+    ``values``, ``ref_low`` and ``ref_high`` are dense users x markers float
+    matrices (NaN where a user has no result); each cell holds the most recent
+    numeric result by ``collected_at`` and the reference range reported with it.
+    ``append`` folds in new rows only, keeping each cell's timestamp in ``when``.
+    """
+    users: Dict[Any, int]
+    markers: List[str]                 # test_name per column
+    loinc: List[Optional[str]]
+    units: List[Optional[str]]
+    values: np.ndarray
+    ref_low: np.ndarray
+    ref_high: np.ndarray
+    lookup: Dict[str, int] = field(default_factory=dict, repr=False)  # normalized name/LOINC -> column
+    when: Optional[np.ndarray] = field(default=None, repr=False)      # collected_at (int64 ns) per cell
+
+    def copy(self) -> "LabMatrix":
+        return LabMatrix(users=dict(self.users), markers=list(self.markers), loinc=list(self.loinc),
+                         units=list(self.units), values=self.values.copy(), ref_low=self.ref_low.copy(),
+                         ref_high=self.ref_high.copy(), lookup=dict(self.lookup), when=self.when.copy())
+
+    def append(self, rows: pd.DataFrame, key: str) -> None:
+        """Fold newly appended lab rows in; cost is O(len(rows)) plus growing the matrix."""
+        if rows is None or rows.empty or not {"test_name", "value"} <= set(rows.columns):
+            return
+        found = _latest_lab_results(rows, key)
+        if found is not None:
+            self._merge(rows, found)
+
+    def _merge(self, labs: pd.DataFrame, found) -> None:
+        # a result replaces the stored cell when it is at least as recent (later rows win ties,
+        # as in a full build); new users and markers get rows/columns in order of appearance
+        rows, mcodes, users, markers, pick, u, m, when = found
+        user_row = np.array([self.users.setdefault(uid, len(self.users)) for uid in users], dtype=np.int64)
+        col_of = {name: j for j, name in enumerate(self.markers)}
+        marker_col = np.array([col_of.setdefault(name, len(col_of)) for name in markers], dtype=np.int64)
+        n_old = len(self.markers)
+        self.markers += [name for name in col_of if col_of[name] >= n_old]
+        loinc = _lab_per_marker(labs, "loinc_code", rows, mcodes, len(markers))
+        units = _lab_per_marker(labs, "unit", rows, mcodes, len(markers))
+        self.loinc += [None] * (len(self.markers) - n_old)
+        self.units += [None] * (len(self.markers) - n_old)
+        for j, col in enumerate(marker_col):
+            if self.loinc[col] is None:
+                self.loinc[col] = loinc[j]
+            if self.units[col] is None:
+                self.units[col] = units[j]
+
+        shape = (len(self.users), len(self.markers))
+        if shape != self.values.shape:
+            def grow(arr, fill, dtype=float):
+                out = np.full(shape, fill, dtype=dtype)
+                out[:arr.shape[0], :arr.shape[1]] = arr
+                return out
+            self.values, self.ref_low, self.ref_high = (grow(a, np.nan) for a in (self.values, self.ref_low, self.ref_high))
+            self.when = grow(self.when, np.iinfo(np.int64).min, np.int64)
+        gu, gm = user_row[u], marker_col[m]
+        newer = np.isnan(self.values[gu, gm]) | (when >= self.when[gu, gm])
+        gu, gm, pick = gu[newer], gm[newer], pick[newer]
+        self.values[gu, gm] = _lab_column(labs, "value", pick)
+        self.ref_low[gu, gm] = _lab_column(labs, "ref_low", pick)
+        self.ref_high[gu, gm] = _lab_column(labs, "ref_high", pick)
+        self.when[gu, gm] = when[newer]
+        self.lookup = {}
+        for j, (name, code) in enumerate(zip(self.markers, self.loinc)):
+            self.lookup.setdefault(_norm_marker(name), j)
+            if code:
+                self.lookup.setdefault(code, j)
+
+    def column(self, marker: str) -> Optional[int]:
+        """Column for a test name, LOINC code or signal alias (e.g. "CRP" -> hs-CRP)."""
+        j = self.lookup.get(_norm_marker(marker))
+        if j is None:
+            j = self.lookup.get(str(marker))
+        if j is None:
+            for alias in _LAB_MARKER_ALIASES.get(marker, []):
+                j = self.lookup.get(alias)
+                if j is not None:
+                    break
+        return j
+
+    def latest(self, user_id: Any, marker: str) -> Optional[float]:
+        i, j = self.users.get(user_id), self.column(marker)
+        if i is None or j is None or np.isnan(self.values[i, j]):
+            return None
+        return float(self.values[i, j])
+
+    def out_of_range(self, user_id: Any):
+        """(high, low) lists of test names whose latest value is outside its reference range."""
+        i = self.users.get(user_id)
+        if i is None:
+            return [], []
+        v = self.values[i]
+        with np.errstate(invalid="ignore"):
+            high = np.flatnonzero(v > self.ref_high[i])
+            low = np.flatnonzero(v < self.ref_low[i])
+        return [self.markers[j] for j in high], [self.markers[j] for j in low]
+
+def _latest_lab_results(labs: pd.DataFrame, key: str):
+    """The latest numeric result per (user, marker) among ``labs``' rows.
+
+    Returns None when no row is usable, else (usable row positions, their marker
+    codes, distinct users, distinct markers, and for each picked result: row
+    position, user code, marker code, ``collected_at`` in int64 ns).
+    """
+    values = pd.to_numeric(labs["value"], errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+    ok = ~np.isnan(values) & labs[key].notna().to_numpy() & labs["test_name"].notna().to_numpy()
+    rows = np.flatnonzero(ok)
+    if len(rows) == 0:
+        return None
+    ucodes, uniq_users = pd.factorize(labs[key].to_numpy()[rows])
+    mcodes, uniq_markers = pd.factorize(labs["test_name"].astype(str).to_numpy()[rows])
+    if "collected_at" in labs.columns:
+        when = pd.to_datetime(labs["collected_at"], errors="coerce").to_numpy().astype("datetime64[ns]").view("int64")[rows]
+    else:
+        when = np.zeros(len(rows), dtype="int64")
+    # sort by (user, marker, time); the last row of every (user, marker) run is the latest result
+    order = np.lexsort((np.arange(len(rows)), when, mcodes, ucodes))
+    u, m = ucodes[order], mcodes[order]
+    last = np.ones(len(order), dtype=bool)
+    last[:-1] = (u[1:] != u[:-1]) | (m[1:] != m[:-1])
+    return (rows, mcodes, uniq_users.tolist(), [str(x) for x in uniq_markers],
+            rows[order[last]], u[last], m[last], when[order[last]])
+
+def _lab_column(labs: pd.DataFrame, col: str, positions: np.ndarray) -> np.ndarray:
+    if col not in labs.columns:
+        return np.full(len(positions), np.nan)
+    return pd.to_numeric(labs[col], errors="coerce").to_numpy(dtype=float, na_value=np.nan)[positions]
+
+def _lab_per_marker(labs: pd.DataFrame, col: str, rows: np.ndarray, mcodes: np.ndarray, n: int) -> List[Optional[str]]:
+    # first non-empty value of ``col`` per marker code
+    if col not in labs.columns:
+        return [None] * n
+    first = pd.Series(labs[col].to_numpy()[rows]).groupby(mcodes).first()
+    return [None if pd.isna(first.get(j)) else str(first.get(j)) for j in range(n)]
+
+def _build_lab_matrix(labs: Optional[pd.DataFrame], key: Optional[str]) -> Optional[LabMatrix]:
+    if labs is None or labs.empty or key is None or not {"test_name", "value"} <= set(labs.columns):
+        return None
+    found = _latest_lab_results(labs, key)
+    if found is None:
+        return None
+    lm = LabMatrix(users={}, markers=[], loinc=[], units=[], values=np.empty((0, 0)),
+                   ref_low=np.empty((0, 0)), ref_high=np.empty((0, 0)), when=np.empty((0, 0), dtype=np.int64))
+    lm._merge(labs, found)
+    return lm
+
+# ---- Wearable rolling windows ----
+_WEARABLE_WINDOW_METRICS = ["resting_hr", "hrv_rmssd", "steps", "sleep_hours", "sleep_efficiency", "spo2_avg"]
+_WEARABLE_WINDOWS = (7, 14, 30)
+
+class WearableWindows:
+    """Per-user rolling 7/14/30-day sum, count, min and max for the daily wearable metrics.
+
+    Each user keeps a ring buffer of their last ``max(windows)`` days (slot =
+    day number modulo the span) and the window aggregates are stored in dense
+    users x windows x metrics arrays, so reads are O(1). ``append`` touches only
+    the new rows and the users they belong to, so a day's worth of new rows
+    never triggers a rescan of the table. Windows end at each user's latest
+    date; a date seen twice keeps the last row.
+    """
+
+    def __init__(self, metrics: List[str], windows=_WEARABLE_WINDOWS):
+        self.metrics = list(metrics)
+        self.windows = tuple(windows)
+        self.span = max(self.windows)
+        self.users: Dict[Any, int] = {}
+        self._alloc(0)
+
+    def _alloc(self, cap: int) -> None:
+        old = getattr(self, "days", None)
+        n_old = 0 if old is None else old.shape[0]
+        nw, nm = len(self.windows), len(self.metrics)
+        def grow(arr, shape, fill, dtype=float):
+            out = np.full(shape, fill, dtype=dtype)
+            if arr is not None:
+                out[:n_old] = arr
+            return out
+        self.latest = grow(getattr(self, "latest", None), (cap,), np.iinfo(np.int64).min, np.int64)
+        self.days = grow(old, (cap, self.span), np.iinfo(np.int64).min, np.int64)
+        self.buf = grow(getattr(self, "buf", None), (cap, self.span, nm), np.nan)
+        self.sum = grow(getattr(self, "sum", None), (cap, nw, nm), np.nan)
+        self.count = grow(getattr(self, "count", None), (cap, nw, nm), 0, np.int64)
+        self.min = grow(getattr(self, "min", None), (cap, nw, nm), np.nan)
+        self.max = grow(getattr(self, "max", None), (cap, nw, nm), np.nan)
+
+    def copy(self) -> "WearableWindows":
+        other = WearableWindows.__new__(WearableWindows)
+        other.__dict__.update(self.__dict__)
+        other.users = dict(self.users)
+        for name in ("latest", "days", "buf", "sum", "count", "min", "max"):
+            setattr(other, name, getattr(self, name).copy())
+        return other
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, key: str, date_col: str = "date") -> Optional["WearableWindows"]:
+        metrics = [m for m in _WEARABLE_WINDOW_METRICS if m in df.columns]
+        if not metrics or date_col not in df.columns:
+            return None
+        store = cls(metrics)
+        store.key, store.date_col = key, date_col
+        store.append(df)
+        return store
+
+    def append(self, rows: pd.DataFrame) -> None:
+        """Fold new daily rows into the windows; cost is O(len(rows))."""
+        if rows is None or rows.empty:
+            return
+        days = pd.to_datetime(rows[self.date_col], errors="coerce").to_numpy().astype("datetime64[D]")
+        ok = ~np.isnat(days) & rows[self.key].notna().to_numpy()
+        if not ok.any():
+            return
+        days = days[ok].astype(np.int64)
+        uids = rows[self.key].array[ok]         # categorical ids factorize through their codes
+        vals = np.column_stack([pd.to_numeric(rows[m], errors="coerce").to_numpy(dtype=float, na_value=np.nan)[ok]
+                                for m in self.metrics])
+
+        # map ids to slots once per distinct id, new ids in order of first appearance
+        local, uniques = pd.factorize(uids)
+        slot = np.empty(len(uniques), dtype=np.int64)
+        for j, uid in enumerate(np.asarray(uniques, dtype=object).tolist()):
+            c = self.users.get(uid)
+            if c is None:
+                c = self.users[uid] = len(self.users)
+            slot[j] = c
+        codes = slot[local]
+        if len(self.users) > self.days.shape[0]:
+            self._alloc(max(len(self.users), 2 * self.days.shape[0]))
+
+        np.maximum.at(self.latest, codes, days)
+        keep = days > self.latest[codes] - self.span
+        codes, days, vals = codes[keep], days[keep], vals[keep]
+        slots = days % self.span
+        self.days[codes, slots] = days
+        self.buf[codes, slots] = vals
+        self._recompute(np.unique(codes))
+
+    def _recompute(self, rows: np.ndarray, chunk: int = 8192) -> None:
+        # Readings are re-laid out by age (days before the user's latest date), which
+        # makes every window a prefix: one running sum/count/min/max pass serves all
+        # windows, with no per-window date mask. Chunked to bound the temporaries.
+        ends = [w - 1 for w in self.windows]
+        for start in range(0, len(rows), chunk):
+            part = rows[start:start + chunk]
+            if part[-1] - part[0] + 1 == len(part):
+                part = slice(part[0], part[-1] + 1)          # contiguous (e.g. the initial build): views, not copies
+            days = self.days[part]                           # (k, span)
+            buf = self.buf[part]                             # (k, span, metrics)
+            latest = self.latest[part][:, None]
+            r, slot = np.nonzero(days > latest - self.span)  # empty slots hold int64 min; stale ones fall outside
+            by_age = np.full(buf.shape, np.nan)
+            by_age[r, (latest[r, 0] - days[r, slot])] = buf[r, slot]
+            present = ~np.isnan(by_age)
+            count = np.cumsum(present, axis=1)[:, ends]
+            total = np.cumsum(np.where(present, by_age, 0.0), axis=1)[:, ends]
+            self.count[part] = count
+            self.sum[part] = np.where(count > 0, total, np.nan)
+            # fmin/fmax skip NaN, so the running extremes are NaN only while the window is empty
+            self.min[part] = np.fmin.accumulate(by_age, axis=1)[:, ends]
+            self.max[part] = np.fmax.accumulate(by_age, axis=1)[:, ends]
+
+    def window(self, user_id: Any, metric: str, days: int = 14) -> Optional[Dict[str, float]]:
+        """sum/count/mean/min/max of ``metric`` over the user's last ``days`` days."""
+        i = self.users.get(user_id)
+        if i is None or metric not in self.metrics or days not in self.windows:
+            return None
+        w, m = self.windows.index(days), self.metrics.index(metric)
+        n = int(self.count[i, w, m])
+        if n == 0:
+            return None
+        total = float(self.sum[i, w, m])
+        return {"sum": total, "count": n, "mean": total / n,
+                "min": float(self.min[i, w, m]), "max": float(self.max[i, w, m])}
+
+    def mean(self, user_id: Any, metric: str, days: int = 14) -> Optional[float]:
+        agg = self.window(user_id, metric, days)
+        return None if agg is None else agg["mean"]
+
+# ---- Peptide catalog index ----
+_CATALOG_TEXT_TERMS = ["indication", "function", "description", "mechanism"]
+
+class CatalogIndex:
+    """Inverted token index over the peptide catalog (main.xlsx), built once per catalog.
+
+    Each row's indication/function/description/mechanism text (all columns if none
+    of those exist) is lower-cased and split into alphanumeric tokens; ``postings``
+    maps a token to the sorted row ids containing it. ``rows_matching`` keeps the
+    rule engine's substring semantics ("neuro" also hits "neuroprotective") by
+    unioning the postings of every vocabulary token that contains the keyword, and
+    memoizes each keyword's row set.
+    """
+
+    def __init__(self, catalog: pd.DataFrame):
+        lower_cols = {str(c).lower(): c for c in catalog.columns}
+        text_cols = [lower_cols[c] for c in lower_cols if any(k in c for k in _CATALOG_TEXT_TERMS)]
+        name_col = lower_cols.get("name") or lower_cols.get("peptide") or list(catalog.columns)[0]
+        self.names = [str(v) for v in catalog[name_col].tolist()]
+        text = catalog[text_cols] if text_cols else catalog
+        self.blobs = [" ".join(str(v) for v in vals).lower() for vals in text.itertuples(index=False, name=None)]
+        postings: Dict[str, list] = {}
+        for row_id, blob in enumerate(self.blobs):
+            for tok in set(re.findall(r"[a-z0-9]+", blob)):
+                postings.setdefault(tok, []).append(row_id)
+        self.postings = {tok: np.asarray(ids, dtype=np.int64) for tok, ids in postings.items()}
+        self._term_rows: Dict[str, np.ndarray] = {}
+
+    def _rows_for_term(self, term: str) -> np.ndarray:
+        term = term.lower()
+        rows = self._term_rows.get(term)
+        if rows is None:
+            if re.fullmatch(r"[a-z0-9]+", term):
+                instrument.count("catalog.tokens_scanned", len(self.postings))
+                hits = [ids for tok, ids in self.postings.items() if term in tok]
+                rows = np.unique(np.concatenate(hits)) if hits else np.empty(0, dtype=np.int64)
+            else:
+                # keywords spanning punctuation/spaces: match the raw text once
+                instrument.count("catalog.rows_scanned", len(self.blobs))
+                rows = np.asarray([i for i, b in enumerate(self.blobs) if term in b], dtype=np.int64)
+            self._term_rows[term] = rows
+        return rows
+
+    def rows_matching(self, keywords: List[str]) -> np.ndarray:
+        """Sorted catalog row ids whose text contains any of ``keywords``."""
+        parts = [self._rows_for_term(k) for k in keywords]
+        rows = np.unique(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+        instrument.count("catalog.rows_matched", len(rows))
+        return rows
+
+# placeholder for a catalog that has not been read yet
+_UNLOADED = object()
+
 @dataclass
 class DataBundle:
-    main: Optional[pd.DataFrame] = None
     pilot_user: Optional[pd.DataFrame] = None
     labs: Optional[pd.DataFrame] = None
     wearable: Optional[pd.DataFrame] = None
@@ -53,200 +506,766 @@ class DataBundle:
 
     user_key: Optional[str] = None
 
-    @classmethod
-    def load(cls) -> "DataBundle":
-        # All CSV files are in the data/ subdirectory, main.xlsx is in root
-        data_dir = Path("data")
-        
-        bundle = cls(
-            main=_read_excel("main.xlsx"),
-            pilot_user=_read_csv(str(data_dir / "pilot_user_data.csv")),
-            labs=_read_csv(str(data_dir / "structured_lab_results.csv")),
-            wearable=_read_csv(str(data_dir / "wearable_daily_aggregates.csv")),
-            microbiome=_read_csv(str(data_dir / "microbiome_summary.csv")),
-            metabolomics=_read_csv(str(data_dir / "metabolomics_summary.csv")),
-            genomics=_read_csv(str(data_dir / "genomic_summary.csv")),
-            meds=_read_csv(str(data_dir / "medication_history.csv")),
-            surveys=_read_csv(str(data_dir / "surveys_adherence_logs.csv")),
-        )
-        # deduce user key
-        for df in [bundle.pilot_user, bundle.labs, bundle.wearable, bundle.microbiome, bundle.metabolomics, bundle.genomics, bundle.meds, bundle.surveys]:
+    # The peptide catalog (main.xlsx) is read on first access to ``main`` or
+    # ``catalog_index``, through ``catalog_loader``; most rule-based requests never
+    # touch it. ``catalog_signature`` is the source file's signature at load time.
+    catalog_loader: Optional[Callable[[], Optional[pd.DataFrame]]] = field(default=None, repr=False)
+    catalog_signature: Optional[tuple] = field(default=None, repr=False)
+    # index the tables on construction; from_tables passes False and indexes against the previous bundle
+    index: InitVar[bool] = True
+
+    # per-user row positions for each user table, built once by index_tables()
+    row_index: Dict[str, Dict[Any, Any]] = field(default_factory=dict, init=False, repr=False)
+    all_users: set = field(default_factory=set, init=False, repr=False)
+    lab_matrix: Optional[LabMatrix] = field(default=None, init=False, repr=False)
+    wearable_windows: Optional[WearableWindows] = field(default=None, init=False, repr=False)
+    # catalog rows as prompt-ready dicts, built on first use by catalog_prompt_sample()
+    catalog_sample: Optional[List[Dict[str, Any]]] = field(default=None, init=False, repr=False)
+    _main: Any = field(default=_UNLOADED, init=False, repr=False)
+    _catalog_index: Any = field(default=_UNLOADED, init=False, repr=False)
+    _catalog_lock: Any = field(default_factory=threading.Lock, init=False, repr=False, compare=False)
+    # similarity index over all users, built on first use by the ``cohort_index`` property
+    _cohort_index: Any = field(default=_UNLOADED, init=False, repr=False)
+    _cohort_lock: Any = field(default_factory=threading.Lock, init=False, repr=False, compare=False)
+
+    def __post_init__(self, index: bool) -> None:
+        if index:
+            self.user_key = self.user_key or self._deduce_user_key()
+            self.index_tables()
+
+    def _deduce_user_key(self) -> Optional[str]:
+        for name in _USER_TABLES:
+            df = getattr(self, name)
             if df is not None:
                 uk = _find_user_key(df)
                 if uk:
-                    bundle.user_key = uk
-                    break
-        return bundle
+                    return uk
+        return None
 
-# ---- Profile extraction ----
-def extract_user_profile(bundle: DataBundle, user_id: Any) -> Dict[str, Any]:
-    profile = {"USERID": user_id, "sources": {}}
+    @property
+    def main(self) -> Optional[pd.DataFrame]:
+        if self._main is _UNLOADED:
+            with self._catalog_lock:
+                if self._main is _UNLOADED:
+                    self._main = self.catalog_loader() if self.catalog_loader is not None else None
+        return self._main
+
+    @property
+    def catalog_index(self) -> Optional[CatalogIndex]:
+        if self._catalog_index is _UNLOADED:
+            main = self.main
+            with self._catalog_lock:
+                if self._catalog_index is _UNLOADED:
+                    self._catalog_index = CatalogIndex(main) if main is not None and not main.empty else None
+        return self._catalog_index
+
+    @property
+    def catalog_loaded(self) -> bool:
+        return self._main is not _UNLOADED
+
+    @property
+    def cohort_index(self) -> Optional["CohortIndex"]:
+        if self._cohort_index is _UNLOADED:
+            with self._cohort_lock:
+                if self._cohort_index is _UNLOADED:
+                    with instrument.span("cohort_index.build"):
+                        self._cohort_index = CohortIndex.build(self)
+        return self._cohort_index
+
+    @classmethod
+    def load(cls, data_dir: str = "data", catalog_path: str = "main.xlsx", use_cache: bool = True) -> "DataBundle":
+        # All CSV files are in the data/ subdirectory, main.xlsx is in root.
+        # By default tables come from the process-wide BUNDLE_CACHE, which only
+        # re-parses files whose mtime/size changed since the previous load.
+        if use_cache:
+            return BUNDLE_CACHE.get(data_dir, catalog_path)
+        snap_dir = str(Path(data_dir) / _SNAPSHOT_DIR)
+        paths = _table_paths(data_dir, catalog_path)
+        catalog = paths.pop("main")
+        tables = {}
+        for name, path in paths.items():
+            tables[name] = _load_table(name, path, _file_signature(path), snap_dir)
+        return cls.from_tables(tables, catalog_loader=lambda: _load_table("main", catalog, _file_signature(catalog), snap_dir),
+                               catalog_signature=_file_signature(catalog))
 
-    def slice_user(df: Optional[pd.DataFrame]) -> Optional[pd.DataFrame]:
-        if df is None: return None
-        key = bundle.user_key or _find_user_key(df)
+    @classmethod
+    def from_tables(cls, tables: Dict[str, Optional[pd.DataFrame]], previous: Optional["DataBundle"] = None,
+                    appended: Optional[Dict[str, int]] = None, catalog_loader: Optional[Callable] = None,
+                    catalog_signature: Optional[tuple] = None) -> "DataBundle":
+        """Bundle over already-parsed user tables.
+
+        A ``"main"`` entry in ``tables`` is used as the (already loaded) catalog;
+        otherwise ``catalog_loader`` reads it on first access.
+        """
+        tables = dict(tables)
+        main = tables.pop("main", _UNLOADED)
+        bundle = cls(**tables, catalog_loader=catalog_loader, catalog_signature=catalog_signature, index=False)
+        bundle._main = main
+        bundle.user_key = bundle._deduce_user_key() or bundle.user_key
+        bundle.index_tables(previous, appended)
+        return bundle
+
+    def _table_key(self, df: pd.DataFrame) -> Optional[str]:
+        key = self.user_key or _find_user_key(df)
         if key and key in df.columns:
-            return df[df[key] == user_id]
+            return key
         return None
 
-    profile["pilot_user"] = slice_user(bundle.pilot_user)
-    profile["labs"] = slice_user(bundle.labs)
-    profile["wearable"] = slice_user(bundle.wearable)
-    profile["microbiome"] = slice_user(bundle.microbiome)
-    profile["metabolomics"] = slice_user(bundle.metabolomics)
-    profile["genomics"] = slice_user(bundle.genomics)
-    profile["meds"] = slice_user(bundle.meds)
-    profile["surveys"] = slice_user(bundle.surveys)
-
-    # Aggregate concise signals
-    signals = {}
-
-    # Labs: basic markers (assume columns like 'marker', 'value', 'unit', 'flag')
-    labs = profile["labs"]
-    if labs is not None and not labs.empty:
-        # find recent
-        date_col = None
-        for c in labs.columns:
-            if "date" in c.lower():
-                date_col = c; break
-        if date_col:
-            labs_sorted = labs.sort_values(date_col, ascending=False).head(50)
+    def index_tables(self, previous: Optional["DataBundle"] = None, appended: Optional[Dict[str, int]] = None) -> None:
+        """Build the user_id -> row positions map for every user table.
+
+        Indexes of tables that are the very same DataFrame in ``previous`` (i.e. the
+        cache did not reload them) are reused instead of rebuilt. For tables listed in
+        ``appended`` (name -> row count before the append) only the new rows are
+        indexed and merged into a copy of the previous index.
+        """
+        appended = appended or {}
+        same_key = previous is not None and previous.user_key == self.user_key
+        self.row_index = {}
+        for name in _USER_TABLES:
+            df = getattr(self, name)
+            if df is None or df.empty:
+                continue
+            key = self._table_key(df)
+            if key is None:
+                continue
+            if same_key and getattr(previous, name) is df and name in previous.row_index:
+                self.row_index[name] = previous.row_index[name]
+            elif same_key and name in appended and name in previous.row_index:
+                n_old = appended[name]
+                idx = dict(previous.row_index[name])
+                for uid, pos in df.iloc[n_old:].groupby(key, sort=False).indices.items():
+                    pos = pos + n_old
+                    idx[uid] = np.concatenate([idx[uid], pos]) if uid in idx else pos
+                self.row_index[name] = idx
+            else:
+                self.row_index[name] = df.groupby(key, sort=False).indices
+        self.all_users = set()
+        for idx in self.row_index.values():
+            self.all_users.update(idx.keys())
+        if same_key and previous.labs is self.labs:
+            self.lab_matrix = previous.lab_matrix
+        elif same_key and "labs" in appended and previous.lab_matrix is not None:
+            # fold just the appended rows into a copy; ``previous`` may still be serving requests
+            self.lab_matrix = previous.lab_matrix.copy()
+            self.lab_matrix.append(self.labs.iloc[appended["labs"]:], self._table_key(self.labs))
         else:
-            labs_sorted = labs.head(50)
-        signals["lab_flags_high"] = list(labs_sorted.columns)
-        # Try to pick common markers if present
-        for marker in ["Vitamin D", "Omega-3 Index", "LDL", "HDL", "CRP", "HbA1c", "Ferritin"]:
-            col = None
-            for c in labs.columns:
-                if marker.lower().replace("-", "").replace(" ", "") in c.lower().replace("-", "").replace(" ", ""):
-                    col = c; break
-            if col:
-                try:
-                    # take the latest numeric value
-                    val = pd.to_numeric(labs[col], errors="coerce").dropna()
-                    if len(val) > 0:
-                        signals[marker] = float(val.iloc[-1])
-                except Exception:
-                    pass
-
-    # Wearables: try sleep/HRV/resting HR if present
-    wearable = profile["wearable"]
-    if wearable is not None and not wearable.empty:
-        for metric in ["sleep_hours", "total_sleep", "hrv", "rhr", "resting_hr", "steps", "vo2max"]:
-            cand = None
-            for c in wearable.columns:
-                if metric.replace("_","") in c.lower().replace("_",""):
-                    cand = c; break
-            if cand:
-                try:
-                    vals = pd.to_numeric(wearable[cand], errors="coerce").dropna()
-                    if len(vals) > 0:
-                        signals[f"wearable_{metric}_avg"] = float(vals.tail(14).mean())
-                except Exception:
-                    pass
-
-    # Microbiome/metabolomics textual captures (diversity score, SCFA, etc. if present)
-    microbiome = profile["microbiome"]
-    if microbiome is not None and not microbiome.empty:
-        for metric in ["diversity", "shannon", "butyrate", "scfa", "inflammation"]:
-            cand = None
-            for c in microbiome.columns:
-                if metric in c.lower():
-                    cand = c; break
-            if cand:
-                try:
-                    vals = pd.to_numeric(microbiome[cand], errors="coerce").dropna()
-                    if len(vals) > 0:
-                        signals[f"microbiome_{metric}_avg"] = float(vals.mean())
-                except Exception:
-                    pass
-
-    metabol = profile["metabolomics"]
-    if metabol is not None and not metabol.empty:
-        for metric in ["vitamin", "omega", "glucose", "carnitine", "amino"]:
-            cand = None
-            for c in metabol.columns:
-                if metric in c.lower():
-                    cand = c; break
-            if cand:
-                try:
-                    vals = pd.to_numeric(metabol[cand], errors="coerce").dropna()
-                    if len(vals) > 0:
-                        signals[f"metabol_{metric}_avg"] = float(vals.mean())
-                except Exception:
-                    pass
-
-    # Genomics: capture notable variants flags if present
-    genom = profile["genomics"]
-    if genom is not None and not genom.empty:
-        variant_cols = [c for c in genom.columns if any(k in c.lower() for k in ["variant", "risk", "allele", "mutation", "snp"])]
-        signals["genomic_flags"] = {}
-        for c in variant_cols[:20]:
-            # just record non-null unique values as flags
-            vals = genom[c].dropna().unique().tolist()
-            if len(vals) > 0:
-                signals["genomic_flags"][c] = vals[:5]
-
-    # Medications: list current meds if present
-    meds = profile["meds"]
-    if meds is not None and not meds.empty:
-        name_col = None
-        for c in meds.columns:
-            if "med" in c.lower() or "drug" in c.lower() or "peptide" in c.lower():
-                name_col = c; break
-        if name_col:
-            current = meds[name_col].dropna().astype(str).unique().tolist()
-            signals["current_meds"] = current[:20]
+            self.lab_matrix = _build_lab_matrix(self.labs, self._table_key(self.labs) if self.labs is not None else None)
+        # reuse the previous bundle's catalog (and its index) while the source is unchanged;
+        # otherwise it stays unloaded until first needed
+        if previous is not None and previous.catalog_loaded and (
+                previous._main is self._main or
+                (not self.catalog_loaded and self.catalog_signature is not None
+                 and previous.catalog_signature == self.catalog_signature)):
+            self._main = previous._main
+            self._catalog_index = previous._catalog_index
+            self.catalog_sample = previous.catalog_sample
+        if same_key and previous.wearable is self.wearable:
+            self.wearable_windows = previous.wearable_windows
+        elif same_key and "wearable" in appended and previous.wearable_windows is not None:
+            # fold just the appended rows into a copy; ``previous`` may still be serving requests
+            self.wearable_windows = previous.wearable_windows.copy()
+            self.wearable_windows.append(self.wearable.iloc[appended["wearable"]:])
+        elif self.wearable is not None and not self.wearable.empty and self._table_key(self.wearable):
+            self.wearable_windows = WearableWindows.from_frame(self.wearable, self._table_key(self.wearable))
+        else:
+            self.wearable_windows = None
+        if same_key and previous._cohort_index is not _UNLOADED:
+            changed = [name for name in _COHORT_TABLES if getattr(previous, name) is not getattr(self, name)]
+            if not changed:
+                self._cohort_index = previous._cohort_index
+            elif previous._cohort_index is not None and all(name in appended for name in changed):
+                # rewrite just the users with new rows, on a copy (``previous`` may still be serving)
+                users = set()
+                for name in changed:
+                    df = getattr(self, name)
+                    users.update(df[self._table_key(df)].iloc[appended[name]:].unique().tolist())
+                self._cohort_index = previous._cohort_index.copy()
+                self._cohort_index.update(self, sorted(users, key=str))
 
-    # Surveys: preferences, allergies, goals
-    surveys = profile["surveys"]
-    if surveys is not None and not surveys.empty:
-        # try to pick common fields
-        for tag in ["allergy", "goal", "avoid", "preference", "nootropic", "caffeine", "sleep", "diet"]:
-            cols = [c for c in surveys.columns if tag in c.lower()]
-            for col in cols:
-                vals = surveys[col].dropna().astype(str).unique().tolist()
-                if vals:
-                    signals[f"survey_{col}"] = vals[:10]
+    def user_rows(self, name: str, user_id: Any) -> Optional[pd.DataFrame]:
+        """Rows of table ``name`` belonging to ``user_id``, in file order.
 
-    profile["signals"] = signals
-    return profile
+        Returns None when the table is missing or has no user key, and an empty
+        frame when the user simply has no rows there.
+        """
+        df = getattr(self, name)
+        if df is None:
+            return None
+        idx = self.row_index.get(name)
+        if idx is None:
+            if df.empty or self._table_key(df) is None:
+                return None
+            # table was attached after indexing; index it now
+            idx = self.row_index[name] = df.groupby(self._table_key(df), sort=False).indices
+        positions = idx.get(user_id)
+        if positions is None:
+            return df.iloc[0:0]
+        return df.iloc[positions]
 
+    def has_user(self, user_id: Any) -> bool:
+        return user_id in self.all_users
 
-def assemble_user_dataframe(bundle: DataBundle, user_id: Any) -> Optional[pd.DataFrame]:
-    """Check all CSV DataFrames for the user_id and return a merged DataFrame of all rows found.
+    def memory_usage(self) -> Dict[str, int]:
+        """Deep in-memory size in bytes of each loaded source table."""
+        tables = {name: getattr(self, name) for name in _USER_TABLES}
+        if self.catalog_loaded:
+            tables = {"main": self._main, **tables}
+        return {name: int(df.memory_usage(deep=True).sum()) for name, df in tables.items() if df is not None}
 
-    The merged DataFrame includes a small column `__source` that indicates which original
-    table the row came from. Returns None if the user is not found in any data source.
+# ---- Append-only ingestion ----
+_EDGE_BYTES = 256
+
+@dataclass
+class _TailState:
+    """How much of a CSV file has been consumed into its cached DataFrame."""
+    offset: int      # byte offset just past the last parsed line
+    rows: int        # rows parsed so far
+    header: bytes    # header line, must not change between reads
+    edge: bytes      # the bytes just before ``offset``, to detect rewrites
+    head: bytes = b""  # the file's first bytes, to detect rewrites from the top
+
+def _tail_state(path: str, sig: Optional[tuple], rows: int) -> Optional[_TailState]:
+    # Only files that end in a newline can be resumed: a partial last line was
+    # parsed as a row and would be duplicated by the next tail read.
+    if sig is None or sig[2] == 0:
+        return None
+    try:
+        with open(path, "rb") as fh:
+            head = fh.read(min(sig[2], _EDGE_BYTES))
+            fh.seek(0)
+            header = fh.readline()
+            fh.seek(max(0, sig[2] - _EDGE_BYTES))
+            edge = fh.read(min(sig[2], _EDGE_BYTES))
+    except OSError:
+        return None
+    if not edge.endswith(b"\n") or _file_signature(path) != sig:
+        return None
+    return _TailState(offset=sig[2], rows=rows, header=header, edge=edge, head=head)
+
+def _read_csv_tail(path: str, state: _TailState, name: Optional[str] = None):
+    """Parse only the complete lines appended after ``state.offset``.
+
+    Returns (new rows, new state), or None when the file was truncated or rewritten
+    (its first bytes, header or the bytes before the old offset changed) and needs a
+    full reload. Only those two windows are compared, so an edit confined to the
+    middle of a same-or-longer file goes unnoticed.
     """
-    parts = []
-    src_map = {
-        'pilot_user': bundle.pilot_user,
-        'labs': bundle.labs,
-        'wearable': bundle.wearable,
-        'microbiome': bundle.microbiome,
-        'metabolomics': bundle.metabolomics,
-        'genomics': bundle.genomics,
-        'meds': bundle.meds,
-        'surveys': bundle.surveys,
-    }
+    try:
+        with open(path, "rb") as fh:
+            head = fh.read(len(state.head))
+            fh.seek(0)
+            header = fh.readline()
+            fh.seek(state.offset - len(state.edge))
+            edge = fh.read(len(state.edge))
+            data = fh.read()
+    except OSError:
+        return None
+    if head != state.head or header != state.header or edge != state.edge:
+        return None
+    end = data.rfind(b"\n") + 1
+    if end == 0:
+        return pd.DataFrame(), state
+    tail = _parse_csv(io.BytesIO(header + data[:end]), name)
+    new_edge = (state.edge + data[:end])[-_EDGE_BYTES:]
+    return tail, _TailState(offset=state.offset + end, rows=state.rows + len(tail), header=header, edge=new_edge,
+                            head=state.head)
 
-    for name, df in src_map.items():
-        if df is None or df.empty:
+def _numeric(dtype) -> bool:
+    return pd.api.types.is_numeric_dtype(dtype) and not pd.api.types.is_bool_dtype(dtype)
+
+def _append_rows(df: pd.DataFrame, tail: pd.DataFrame) -> Optional[pd.DataFrame]:
+    """``df`` with ``tail`` appended, typed as a full parse of both would be.
+
+    Returns None when a column's inferred type changed (say a text answer in a column
+    that was all numbers), which only a full reload gets right.
+    """
+    tail = tail.reindex(columns=df.columns)
+    for c in df.columns:
+        have, got = df[c].dtype, tail[c].dtype
+        if isinstance(have, pd.CategoricalDtype) or have == got:
             continue
-        # determine key for this dataframe
-        key = bundle.user_key or _find_user_key(df)
-        if not key or key not in df.columns:
+        if tail[c].isna().all():
+            # an all-empty tail column parses as float; it holds no values of its own
+            if not pd.api.types.is_integer_dtype(have):
+                tail[c] = tail[c].astype(have)
+        elif not (_numeric(have) and _numeric(got)):
+            return None
+    # keep categorical columns categorical across the concat (the tail has its own categories)
+    for c in df.columns:
+        if isinstance(df[c].dtype, pd.CategoricalDtype):
+            cats = df[c].cat.categories
+            extra = [v for v in pd.unique(tail[c].dropna().astype(str)) if v not in cats]
+            col = df[c].cat.add_categories(extra) if extra else df[c]
+            tail[c] = pd.Categorical(tail[c].astype(str).where(tail[c].notna()), categories=col.cat.categories)
+            if extra:
+                df = df.assign(**{c: col})
+    return pd.concat([df, tail], ignore_index=True)
+
+# ---- Shared bundle cache ----
+class BundleCache:
+    """Thread-safe, process-wide cache of parsed source tables.
+
+    Every table is keyed on its file's (path, mtime, size). ``get`` re-parses only the
+    tables whose files changed and hands back the same ``DataBundle`` instance while
+    nothing changed, so callers must treat the cached DataFrames as read-only.
+
+    CSV files are treated as append-only logs: when one grows, only the complete
+    lines after the last consumed byte offset are parsed and appended to the
+    cached table and its per-user index. A truncated or rewritten file (changed
+    first bytes, header or bytes before the old offset), or a tail that changes a
+    column's type, falls back to a full reload.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._tables: Dict[str, tuple] = {}    # abs path -> (signature, DataFrame or None, _TailState or None)
+        self._bundles: Dict[tuple, DataBundle] = {}  # (data_dir, catalog) -> last bundle
+        self.hits = 0      # table served from cache
+        self.misses = 0    # table parsed for the first time
+        self.reloads = 0   # table re-parsed because its file changed
+        self.appends = 0   # table extended by parsing only its appended tail
+
+    def _table(self, name: str, path: str, snap_dir: str, appended: Dict[str, int]) -> Optional[pd.DataFrame]:
+        key = os.path.abspath(path)
+        sig = _file_signature(path)
+        entry = self._tables.get(key)
+        if entry is not None and entry[0] == sig:
+            self.hits += 1
+            instrument.count("bundle_cache.hit")
+            return entry[1]
+        if entry is not None and entry[1] is not None and entry[2] is not None and sig is not None:
+            with instrument.span(f"load.tail.{name}"):
+                res = _read_csv_tail(path, entry[2], name)
+            if res is not None:
+                tail, state = res
+                df = _append_rows(entry[1], tail) if not tail.empty else entry[1]
+                if df is not None:
+                    if df is not entry[1]:
+                        appended[name] = len(entry[1])
+                    # the file may have grown again while we read; then resume next time
+                    self._tables[key] = (sig if state.offset == sig[2] else None, df, state)
+                    self.appends += 1
+                    instrument.count("bundle_cache.append")
+                    instrument.count("rows.parsed", len(tail))
+                    return df
+        if entry is None:
+            self.misses += 1
+            instrument.count("bundle_cache.miss")
+        else:
+            self.reloads += 1
+            instrument.count("bundle_cache.reload")
+        with instrument.span(f"load.parse.{name}"):
+            df = _load_table(name, path, sig, snap_dir)
+        if df is not None:
+            instrument.count("rows.parsed", len(df))
+        state = _tail_state(path, sig, len(df)) if df is not None and name != "main" else None
+        self._tables[key] = (sig, df, state)
+        return df
+
+    def _catalog(self, path: str, snap_dir: str) -> Optional[pd.DataFrame]:
+        with self._lock:
+            return self._table("main", path, snap_dir, {})
+
+    def get(self, data_dir: str = "data", catalog_path: str = "main.xlsx") -> DataBundle:
+        snap_dir = str(Path(data_dir) / _SNAPSHOT_DIR)
+        with self._lock:
+            tables, appended = {}, {}
+            paths = _table_paths(data_dir, catalog_path)
+            catalog = paths.pop("main")
+            for name, path in paths.items():
+                tables[name] = self._table(name, path, snap_dir, appended)
+            # the catalog itself is only parsed when a bundle first needs it
+            catalog_sig = _file_signature(catalog)
+            root = (os.path.abspath(data_dir), os.path.abspath(catalog_path))
+            bundle = self._bundles.get(root)
+            if bundle is None or bundle.catalog_signature != catalog_sig or any(
+                    getattr(bundle, name) is not df for name, df in tables.items()):
+                with instrument.span("load.index"):
+                    bundle = DataBundle.from_tables(tables, previous=bundle, appended=appended,
+                                                    catalog_loader=partial(self._catalog, catalog, snap_dir),
+                                                    catalog_signature=catalog_sig)
+                self._bundles[root] = bundle
+            return bundle
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "reloads": self.reloads,
+                    "appends": self.appends, "files": len(self._tables)}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tables.clear()
+            self._bundles.clear()
+            self.hits = self.misses = self.reloads = self.appends = 0
+
+BUNDLE_CACHE = BundleCache()
+
+def compile_snapshot(data_dir: str = "data", catalog_path: str = "main.xlsx") -> str:
+    """Parse every source file and write the columnar snapshot that DataBundle.load memory-maps.
+
+    Returns the snapshot directory. Tables whose source file is missing are skipped.
+    """
+    tables, sources = {}, {}
+    for name, path in _table_paths(data_dir, catalog_path).items():
+        # signature taken before parsing, so a file that changes meanwhile reads as stale
+        sources[name] = _file_signature(path)
+        tables[name] = _load_table(name, path, sources[name])
+    import snapshot
+    return snapshot.write_snapshot(tables, sources, str(Path(data_dir) / _SNAPSHOT_DIR))
+
+# ---- Profile extraction ----
+# Signals looked up by substring match against each table's column names
+_LAB_MARKERS = ["Vitamin D", "Omega-3 Index", "LDL", "HDL", "CRP", "HbA1c", "Ferritin"]
+_WEARABLE_METRICS = ["sleep_hours", "total_sleep", "hrv", "rhr", "resting_hr", "steps", "vo2max"]
+_MICROBIOME_METRICS = ["diversity", "shannon", "butyrate", "scfa", "inflammation"]
+_METABOL_METRICS = ["vitamin", "omega", "glucose", "carnitine", "amino"]
+_GENOMIC_TERMS = ["variant", "risk", "allele", "mutation", "snp"]
+_SURVEY_TAGS = ["allergy", "goal", "avoid", "preference", "nootropic", "caffeine", "sleep", "diet"]
+
+def _first_column(columns, needle: str, strip: str = "") -> Optional[str]:
+    def norm(x):
+        x = x.lower()
+        for ch in strip:
+            x = x.replace(ch, "")
+        return x
+    target = norm(needle)
+    for c in columns:
+        if target in norm(c):
+            return c
+    return None
+
+@dataclass(frozen=True)
+class SignalSpec:
+    """Column mappings for every profile signal, resolved once per bundle schema.
+
+    Built by ``SignalSpec.for_bundle``, which memoizes on the tuple of column names
+    of each user table, so the substring matching runs once per schema rather than
+    once per request.
+    """
+    lab_columns: Optional[tuple] = None          # set when the labs table exists
+    lab_markers: tuple = ()                      # (marker, column)
+    wearable: tuple = ()                         # (signal name, column)
+    microbiome: tuple = ()
+    metabolomics: tuple = ()
+    genomic_columns: Optional[tuple] = None      # set when the genomics table exists
+    meds_column: Optional[str] = None
+    survey_columns: tuple = ()                   # (signal name, column)
+
+    @classmethod
+    def for_bundle(cls, bundle: DataBundle) -> "SignalSpec":
+        schema = []
+        for name in _USER_TABLES:
+            df = getattr(bundle, name)
+            schema.append(None if df is None else tuple(df.columns))
+        return _compile_signal_spec(tuple(schema))
+
+@lru_cache(maxsize=32)
+def _compile_signal_spec(schema: tuple) -> SignalSpec:
+    cols = dict(zip(_USER_TABLES, schema))
+    spec = {}
+    labs = cols["labs"]
+    if labs is not None:
+        spec["lab_columns"] = labs
+        spec["lab_markers"] = tuple((m, c) for m in _LAB_MARKERS
+                                    for c in [_first_column(labs, m, strip="- ")] if c)
+    if cols["wearable"] is not None:
+        spec["wearable"] = tuple((f"wearable_{m}_avg", c) for m in _WEARABLE_METRICS
+                                 for c in [_first_column(cols["wearable"], m, strip="_")] if c)
+    if cols["microbiome"] is not None:
+        spec["microbiome"] = tuple((f"microbiome_{m}_avg", c) for m in _MICROBIOME_METRICS
+                                   for c in [_first_column(cols["microbiome"], m)] if c)
+    if cols["metabolomics"] is not None:
+        spec["metabolomics"] = tuple((f"metabol_{m}_avg", c) for m in _METABOL_METRICS
+                                     for c in [_first_column(cols["metabolomics"], m)] if c)
+    if cols["genomics"] is not None:
+        variant_cols = [c for c in cols["genomics"] if any(k in c.lower() for k in _GENOMIC_TERMS)]
+        spec["genomic_columns"] = tuple(variant_cols[:20])
+    if cols["meds"] is not None:
+        for c in cols["meds"]:
+            if "med" in c.lower() or "drug" in c.lower() or "peptide" in c.lower():
+                spec["meds_column"] = c; break
+    if cols["surveys"] is not None:
+        spec["survey_columns"] = tuple((f"survey_{c}", c) for tag in _SURVEY_TAGS
+                                       for c in cols["surveys"] if tag in c.lower())
+    return SignalSpec(**spec)
+
+@dataclass
+class ProfileSignals:
+    """Typed per-user signal record produced by compute_signals.
+
+    ``as_dict`` renders the flat ``signals`` mapping consumed by the rule engine,
+    the LLM prompt and the JSON output.
+    """
+    user_id: Any
+    lab_flags_high: Optional[List[str]] = None
+    lab_flags_low: Optional[List[str]] = None
+    labs: Dict[str, float] = field(default_factory=dict)
+    wearable: Dict[str, float] = field(default_factory=dict)
+    microbiome: Dict[str, float] = field(default_factory=dict)
+    metabolomics: Dict[str, float] = field(default_factory=dict)
+    genomic_flags: Optional[Dict[str, list]] = None
+    current_meds: Optional[List[str]] = None
+    surveys: Dict[str, list] = field(default_factory=dict)
+
+    def as_dict(self) -> Dict[str, Any]:
+        signals = {}
+        if self.lab_flags_high is not None:
+            signals["lab_flags_high"] = self.lab_flags_high
+        if self.lab_flags_low is not None:
+            signals["lab_flags_low"] = self.lab_flags_low
+        signals.update(self.labs)
+        signals.update(self.wearable)
+        signals.update(self.microbiome)
+        signals.update(self.metabolomics)
+        if self.genomic_flags is not None:
+            signals["genomic_flags"] = self.genomic_flags
+        if self.current_meds is not None:
+            signals["current_meds"] = self.current_meds
+        signals.update(self.surveys)
+        return signals
+
+def _gather(bundle: DataBundle, name: str, users: List[Any]):
+    """Row positions of ``users`` in table ``name`` plus a parallel group-code array.
+
+    Positions come straight from the per-user index, concatenated user by user, so
+    each group is a contiguous, file-ordered run and no key column has to be scanned
+    or factorized. Returns None when no requested user has rows in the table.
+    """
+    df = getattr(bundle, name)
+    idx = bundle.row_index.get(name)
+    if df is None or not idx:
+        return None
+    present = [u for u in users if u in idx]
+    if not present:
+        return None
+    parts = [idx[u] for u in present]
+    positions = np.concatenate(parts)
+    codes = np.repeat(np.arange(len(present)), [len(p) for p in parts])
+    return df, present, positions, codes
+
+def _numeric_values(df: pd.DataFrame, col: str, positions: np.ndarray) -> np.ndarray:
+    s = df[col]
+    if pd.api.types.is_numeric_dtype(s.dtype) and not pd.api.types.is_bool_dtype(s.dtype):
+        return s.to_numpy(dtype=float, na_value=np.nan)[positions]
+    # only the gathered rows are converted, never the whole column
+    return pd.to_numeric(pd.Series(s.to_numpy()[positions]), errors="coerce").to_numpy(dtype=float, na_value=np.nan)
+
+def _group_mean(values: np.ndarray, codes: np.ndarray, n: int, tail: Optional[int] = None) -> np.ndarray:
+    # NaN-skipping per-group mean; with ``tail`` only each group's last readings count
+    mask = ~np.isnan(values)
+    v, c = values[mask], codes[mask]
+    if tail is not None:
+        ends = np.cumsum(np.bincount(c, minlength=n))
+        keep = np.arange(len(c)) >= ends[c] - tail
+        v, c = v[keep], c[keep]
+    counts = np.bincount(c, minlength=n)
+    totals = np.bincount(c, weights=v, minlength=n)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return totals / counts
+
+def _group_last(values: np.ndarray, codes: np.ndarray, n: int) -> np.ndarray:
+    # last non-NaN value of each group in file order
+    mask = ~np.isnan(values)
+    v, c = values[mask], codes[mask]
+    counts = np.bincount(c, minlength=n)
+    out = np.full(n, np.nan)
+    has = counts > 0
+    out[has] = v[np.cumsum(counts)[has] - 1]
+    return out
+
+def _group_unique(df: pd.DataFrame, col: str, positions: np.ndarray, codes: np.ndarray, n: int,
+                  limit: int, as_str: bool = False) -> List[list]:
+    # non-null unique values of each group, in order of appearance
+    arr = df[col].to_numpy()[positions]
+    notna = ~pd.isna(arr)
+    vals = arr.tolist()
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(codes, minlength=n))])
+    out = []
+    for g in range(n):
+        seen = dict.fromkeys(vals[i] for i in range(bounds[g], bounds[g + 1]) if notna[i])
+        out.append([str(v) for v in seen][:limit] if as_str else list(seen)[:limit])
+    return out
+
+def compute_signals(bundle: DataBundle, user_ids: Optional[List[Any]] = None) -> Dict[Any, ProfileSignals]:
+    """Compute ProfileSignals for one user, many users or (``None``) the whole bundle.
+
+    Rows are located through the per-user index and every numeric signal is one
+    vectorized group reduction (bincount) per mapped column, so the cost is
+    proportional to the requested users' rows. Users with no rows anywhere are
+    left out of the result.
+    """
+    spec = SignalSpec.for_bundle(bundle)
+    if user_ids is None:
+        user_ids = list(bundle.all_users)
+    users = [u for u in dict.fromkeys(user_ids) if bundle.has_user(u)]
+    records = {u: ProfileSignals(user_id=u) for u in users}
+
+    # Labs: long-format results come from the precomputed latest-value matrix
+    # (markers resolved once; every user's row read and range-checked in one block)
+    lm = bundle.lab_matrix
+    in_lm = [u for u in users if u in lm.users] if lm is not None else []
+    if in_lm:
+        rows = np.array([lm.users[u] for u in in_lm], dtype=np.int64)
+        block = lm.values[rows]
+        with np.errstate(invalid="ignore"):
+            flags = (block > lm.ref_high[rows], block < lm.ref_low[rows])
+        high, low = [[] for _ in in_lm], [[] for _ in in_lm]
+        for out, mask in zip((high, low), flags):
+            for r, j in zip(*np.nonzero(mask)):
+                out[r].append(lm.markers[j])
+        cols = [(marker, lm.column(marker)) for marker in _LAB_MARKERS]
+        cols = [(marker, j) for marker, j in cols if j is not None]
+        latest = block[:, [j for _, j in cols]].tolist()
+        for r, uid in enumerate(in_lm):
+            rec = records[uid]
+            rec.lab_flags_high, rec.lab_flags_low = high[r], low[r]
+            for (marker, _), v in zip(cols, latest[r]):
+                if v == v:      # not NaN
+                    rec.labs[marker] = v
+    # Wide-format labs: latest numeric value per marker column
+    g = _gather(bundle, "labs", users) if lm is None else None
+    if g is not None:
+        df, present, pos, codes = g
+        for uid in present:
+            records[uid].lab_flags_high = list(spec.lab_columns)
+        for marker, col in spec.lab_markers:
+            for uid, v in zip(present, _group_last(_numeric_values(df, col, pos), codes, len(present))):
+                if not np.isnan(v):
+                    records[uid].labs[marker] = float(v)
+
+    # Wearables: 14-day means, read from the rolling-window store where it covers the column
+    ww = bundle.wearable_windows
+    windowed = [(n, c) for n, c in spec.wearable if ww is not None and 14 in ww.windows and c in ww.metrics]
+    in_ww = [u for u in users if u in ww.users] if windowed else []
+    if in_ww:
+        rows = np.array([ww.users[u] for u in in_ww], dtype=np.int64)
+        w, m = ww.windows.index(14), [ww.metrics.index(c) for _, c in windowed]
+        count = ww.count[rows, w][:, m]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = (ww.sum[rows, w][:, m] / count).tolist()
+        for r, uid in enumerate(in_ww):
+            for (sig_name, _), n, v in zip(windowed, count[r], means[r]):
+                if n:
+                    records[uid].wearable[sig_name] = v
+    # other wearable columns: mean of the last 14 numeric readings
+    rest = [(n, c) for n, c in spec.wearable if (n, c) not in windowed]
+    g = _gather(bundle, "wearable", users) if rest else None
+    if g is not None:
+        df, present, pos, codes = g
+        for sig_name, col in rest:
+            for uid, v in zip(present, _group_mean(_numeric_values(df, col, pos), codes, len(present), tail=14)):
+                if not np.isnan(v):
+                    records[uid].wearable[sig_name] = float(v)
+    for uid in users:
+        # keep the signal order stable (spec order) whichever path produced a value
+        w = records[uid].wearable
+        if w:
+            records[uid].wearable = {n: w[n] for n, _ in spec.wearable if n in w}
+
+    # Microbiome/metabolomics: plain averages
+    for name in ["microbiome", "metabolomics"]:
+        g = _gather(bundle, name, users)
+        if g is None:
             continue
+        df, present, pos, codes = g
+        for sig_name, col in getattr(spec, name):
+            for uid, v in zip(present, _group_mean(_numeric_values(df, col, pos), codes, len(present))):
+                if not np.isnan(v):
+                    getattr(records[uid], name)[sig_name] = float(v)
+
+    # Genomics: notable variant flags
+    g = _gather(bundle, "genomics", users)
+    if g is not None:
+        df, present, pos, codes = g
+        for uid in present:
+            records[uid].genomic_flags = {}
+        for col in spec.genomic_columns or ():
+            for uid, vals in zip(present, _group_unique(df, col, pos, codes, len(present), 5)):
+                if vals:
+                    records[uid].genomic_flags[col] = vals
+
+    # Medications: current meds
+    g = _gather(bundle, "meds", users)
+    if g is not None and spec.meds_column:
+        df, present, pos, codes = g
+        for uid, vals in zip(present, _group_unique(df, spec.meds_column, pos, codes, len(present), 20, as_str=True)):
+            records[uid].current_meds = vals
+
+    # Surveys: preferences, allergies, goals
+    g = _gather(bundle, "surveys", users)
+    if g is not None:
+        df, present, pos, codes = g
+        for sig_name, col in spec.survey_columns:
+            for uid, vals in zip(present, _group_unique(df, col, pos, codes, len(present), 10, as_str=True)):
+                if vals:
+                    records[uid].surveys[sig_name] = vals
+
+    return records
+
+class UserView(dict):
+    """One user's profile: their signals plus, on first access only, the per-table
+    row slices (each taken once from the bundle's row index) and the merged frame.
+
+    A drop-in for the old profile dict; ``profile["labs"]``, ``profile["merged_df"]``
+    and their ``.get`` forms build the value lazily and keep it.
+    """
+
+    def __init__(self, bundle: DataBundle, user_id: Any, record: Optional[ProfileSignals] = None):
+        super().__init__(USERID=user_id, sources={})
+        self._bundle = bundle
+        if record is None:
+            with instrument.span("profile.signals"):
+                record = compute_signals(bundle, [user_id]).get(user_id) or ProfileSignals(user_id=user_id)
+        self["signal_record"] = record
+        self["signals"] = record.as_dict()
+
+    def __missing__(self, key):
+        if key in _USER_TABLES:
+            with instrument.span("profile.slice"):
+                rows = self._bundle.user_rows(key, self["USERID"])
+            instrument.count("rows.sliced", 0 if rows is None else len(rows))
+            self[key] = rows
+            return rows
+        if key != "merged_df":
+            raise KeyError(key)
+        with instrument.span("profile.merge"):
+            merged = _merge_user_rows({name: self[name] for name in _USER_TABLES})
+        self[key] = merged
+        return merged
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+def extract_user_profile(bundle: DataBundle, user_id: Any) -> Dict[str, Any]:
+    return UserView(bundle, user_id)
+
+
+def _merge_user_rows(slices: Dict[str, Optional[pd.DataFrame]]) -> Optional[pd.DataFrame]:
+    parts = []
+    for name, user_rows in slices.items():
         try:
-            user_rows = df[df[key] == user_id]
             if user_rows is None or user_rows.empty:
                 continue
+            # categoricals become plain values for these few rows: concat would otherwise
+            # materialise every category of each table's cohort-wide dictionary.
+            # The rows are already a copy (user_rows gathers them with iloc).
+            cols = {}
+            for c, dt in user_rows.dtypes.items():
+                s = user_rows[c]
+                if isinstance(dt, pd.CategoricalDtype):
+                    cols[c] = dt.categories.array.take(s.cat.codes.to_numpy(), allow_fill=True)
+                else:
+                    cols[c] = s.array
             # add source column to keep provenance
-            temp = user_rows.copy()
-            temp['__source'] = name
+            cols['__source'] = [name] * len(user_rows)
+            temp = pd.DataFrame(cols, copy=False)
             parts.append(temp)
-        except Exception:
+        except Exception as exc:
+            instrument.record_error("merge", exc)
             continue
 
     if not parts:
@@ -254,11 +1273,301 @@ def assemble_user_dataframe(bundle: DataBundle, user_id: Any) -> Optional[pd.Dat
     try:
         merged = pd.concat(parts, ignore_index=True, sort=False)
         return merged
-    except Exception:
+    except Exception as exc:
+        instrument.record_error("merge", exc)
+        return None
+
+def assemble_user_dataframe(bundle: DataBundle, user_id: Any) -> Optional[pd.DataFrame]:
+    """Check all CSV DataFrames for the user_id and return a merged DataFrame of all rows found.
+
+    The merged DataFrame includes a small column `__source` that indicates which original
+    table the row came from. Returns None if the user is not found in any data source.
+    """
+    if not bundle.has_user(user_id):
+        return None
+    return _merge_user_rows({name: bundle.user_rows(name, user_id) for name in _USER_TABLES})
+
+# ---- Cohort (batch) profile extraction ----
+def extract_cohort_signals(bundle: DataBundle, user_ids: Optional[List[Any]] = None) -> Dict[Any, Dict[str, Any]]:
+    """The extract_user_profile ``signals`` dict for many users at once (see compute_signals)."""
+    return {uid: rec.as_dict() for uid, rec in compute_signals(bundle, user_ids).items()}
+
+# ---- Cohort similarity index ----
+# Long-format tables whose per-label values become features: table -> (label column, value column)
+_COHORT_LONG_FEATURES = {
+    "microbiome": ("taxa_name", "relative_abundance"),
+    "metabolomics": ("metabolite_name", "concentration"),
+}
+_COHORT_WEARABLE_DAYS = 30
+_COHORT_TABLES = ("labs", "wearable") + tuple(_COHORT_LONG_FEATURES)
+
+# Neighbours attached as "similar_users" by the long-running front ends (server.py, app.py;
+# 0 turns it off). One-shot calls opt in with ``similar=k``: the first query builds the
+# whole-cohort index.
+SIMILAR_USERS_K = int(os.getenv("SIMILAR_USERS_K", "5"))
+
+def _cohort_features(bundle: DataBundle, users: List[Any], columns: Optional[List[str]] = None):
+    """Raw (unscaled) users x features matrix, NaN where a user has no value.
+
+    ``columns`` fixes the feature set (labels outside it are ignored); with None it
+    is discovered from the data. Returns (columns, matrix).
+    """
+    blocks, names = [], []
+    lm = bundle.lab_matrix
+    if lm is not None:
+        rows = np.array([lm.users.get(u, -1) for u in users], dtype=np.int64)
+        block = np.full((len(users), len(lm.markers)), np.nan)
+        block[rows >= 0] = lm.values[rows[rows >= 0]]
+        blocks.append(block)
+        names += [f"labs:{m}" for m in lm.markers]
+    ww = bundle.wearable_windows
+    if ww is not None and _COHORT_WEARABLE_DAYS in ww.windows:
+        w = ww.windows.index(_COHORT_WEARABLE_DAYS)
+        rows = np.array([ww.users.get(u, -1) for u in users], dtype=np.int64)
+        block = np.full((len(users), len(ww.metrics)), np.nan)
+        have = rows[rows >= 0]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            block[rows >= 0] = ww.sum[have, w] / ww.count[have, w]
+        blocks.append(block)
+        names += [f"wearable:{m}" for m in ww.metrics]
+    for name, (label_col, value_col) in _COHORT_LONG_FEATURES.items():
+        df = getattr(bundle, name)
+        if df is None or label_col not in df.columns or value_col not in df.columns:
+            continue
+        g = _gather(bundle, name, users)
+        labels = pd.Categorical(df[label_col].array.take(g[2]) if g is not None else [])
+        if columns is None:
+            labels = labels.remove_unused_categories()
+            wanted = [str(c) for c in labels.categories]
+        else:
+            wanted = [c.split(":", 1)[1] for c in columns if c.startswith(name + ":")]
+        block = np.full((len(users), len(wanted)), np.nan)
+        if g is not None and wanted:
+            _, present, pos, codes = g
+            col_of = {label: j for j, label in enumerate(wanted)}
+            lab = np.array([col_of.get(str(c), -1) for c in labels.categories] + [-1], dtype=np.int64)[labels.codes]
+            vals = _numeric_values(df, value_col, pos)
+            ok = (lab >= 0) & ~np.isnan(vals)
+            # latest (last in file order) value per (user, label)
+            cell = codes[ok] * len(wanted) + lab[ok]
+            _, last_rev = np.unique(cell[::-1], return_index=True)
+            pick = len(cell) - 1 - last_rev
+            row_of = {u: i for i, u in enumerate(users)}
+            user_row = np.array([row_of[u] for u in present], dtype=np.int64)
+            block[user_row[codes[ok][pick]], lab[ok][pick]] = vals[ok][pick]
+        blocks.append(block)
+        names += [f"{name}:{label}" for label in wanted]
+    if columns is not None:
+        # same order as the index, whatever the current tables hold
+        at = {c: j for j, c in enumerate(names)}
+        raw = np.hstack(blocks) if blocks else np.empty((len(users), 0))
+        out = np.full((len(users), len(columns)), np.nan)
+        for j, c in enumerate(columns):
+            if c in at:
+                out[:, j] = raw[:, at[c]]
+        return list(columns), out
+    return names, (np.hstack(blocks) if blocks else np.empty((len(users), 0)))
+
+class CohortIndex:
+    """Exact k-nearest-neighbour index over one feature vector per user.
+
+    Features are the latest value of each lab marker, 30-day wearable means and the
+    latest abundance / concentration per microbiome taxon and metabolite. Columns
+    are z-scored with the cohort mean/std taken at build time (a missing value sits
+    at the mean), every source gets the same total weight and rows are
+    L2-normalised, so a query is one float32 matrix-vector product (cosine
+    similarity) and a partial sort.
+
+    ``update`` rescales and writes just the given users' rows, appending new users,
+    so freshly ingested users are searchable without a rebuild. The scaling itself
+    is only refreshed by a rebuild (the cache does one when a table is reloaded).
+    """
+
+    def __init__(self, columns: List[str], mean: np.ndarray, std: np.ndarray, weight: np.ndarray):
+        self.columns = columns
+        self.mean, self.std, self.weight = mean, std, weight
+        self.users: Dict[Any, int] = {}
+        self.user_ids: List[Any] = []
+        self.vectors = np.zeros((0, len(columns)), dtype=np.float32)
+        self.valid = np.zeros(0, dtype=bool)    # rows with at least one feature
+
+    @classmethod
+    def build(cls, bundle: DataBundle) -> Optional["CohortIndex"]:
+        users = sorted(bundle.all_users, key=str)
+        columns, raw = _cohort_features(bundle, users)
+        if not columns or not users:
+            return None
+        with np.errstate(invalid="ignore"), warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)   # all-NaN columns
+            mean = np.nanmean(raw, axis=0)
+            std = np.nanstd(raw, axis=0)
+        mean = np.where(np.isnan(mean), 0.0, mean)
+        std = np.where(std > 0, std, 1.0)
+        sources = [c.split(":", 1)[0] for c in columns]
+        weight = np.array([1.0 / np.sqrt(sources.count(src)) for src in sources])
+        index = cls(columns, mean, std, weight)
+        index._put(users, raw)
+        return index
+
+    def _put(self, users: List[Any], raw: np.ndarray) -> None:
+        z = (raw - self.mean) / self.std * self.weight
+        z[np.isnan(z)] = 0.0
+        norms = np.linalg.norm(z, axis=1)
+        valid = norms > 0
+        z[valid] /= norms[valid, None]
+        rows = np.empty(len(users), dtype=np.int64)
+        for i, uid in enumerate(users):
+            r = self.users.get(uid)
+            if r is None:
+                r = self.users[uid] = len(self.user_ids)
+                self.user_ids.append(uid)
+            rows[i] = r
+        if len(self.user_ids) > len(self.valid):
+            cap = max(len(self.user_ids), 2 * len(self.valid))
+            vectors = np.zeros((cap, len(self.columns)), dtype=np.float32)
+            vectors[:len(self.valid)] = self.vectors
+            flags = np.zeros(cap, dtype=bool)
+            flags[:len(self.valid)] = self.valid
+            self.vectors, self.valid = vectors, flags
+        self.vectors[rows] = z
+        self.valid[rows] = valid
+
+    def update(self, bundle: DataBundle, user_ids: List[Any]) -> None:
+        """Recompute the rows of ``user_ids`` (new users are appended); cost is O(their rows)."""
+        users = list(dict.fromkeys(u for u in user_ids if bundle.has_user(u)))
+        if users:
+            self._put(users, _cohort_features(bundle, users, self.columns)[1])
+
+    def copy(self) -> "CohortIndex":
+        other = CohortIndex.__new__(CohortIndex)
+        other.__dict__.update(self.__dict__)
+        other.users = dict(self.users)
+        other.user_ids = list(self.user_ids)
+        other.vectors = self.vectors.copy()
+        other.valid = self.valid.copy()
+        return other
+
+    def neighbors(self, user_id: Any, k: int = 5) -> List[tuple]:
+        """The ``k`` most similar other users as (user_id, cosine similarity), best first."""
+        i = self.users.get(user_id)
+        n = len(self.user_ids)
+        if i is None or not self.valid[i] or k <= 0 or n < 2:
+            return []
+        sims = self.vectors[:n] @ self.vectors[i]
+        sims[~self.valid[:n]] = -np.inf
+        sims[i] = -np.inf
+        k = min(k, n - 1)
+        top = np.argpartition(sims, n - k)[n - k:]
+        top = top[np.argsort(-sims[top], kind="stable")]
+        return [(self.user_ids[j], float(sims[j])) for j in top if sims[j] > -np.inf]
+
+def _column_at(df: pd.DataFrame, col: str, positions: np.ndarray) -> list:
+    if col not in df.columns:
+        return [None] * len(positions)
+    arr = df[col].array
+    if isinstance(arr, pd.Categorical):
+        # look up just these codes; converting the taken Categorical materializes every category
+        categories = arr.categories
+        return [categories[c] if c >= 0 else None for c in arr.codes[positions]]
+    return arr.take(positions).tolist()
+
+def _active_stacks(bundle: DataBundle, users: List[Any]) -> List[List[Dict[str, Any]]]:
+    """Per user, the medications not yet stopped (no end date, or one still ahead), in file order."""
+    stacks = [[] for _ in users]
+    g = _gather(bundle, "meds", users)
+    if g is None or "name" not in g[0].columns:
+        return stacks
+    df, present, pos, codes = g
+    if "end_date" in df.columns:
+        end = df["end_date"].to_numpy()[pos]
+        if np.issubdtype(end.dtype, np.datetime64):
+            keep = np.isnat(end) | (end >= np.datetime64("now"))
+            pos, codes = pos[keep], codes[keep]
+    row_of = {u: i for i, u in enumerate(users)}
+    owner = [row_of[present[c]] for c in codes]
+    starts = df["start_date"].to_numpy()[pos] if "start_date" in df.columns else np.full(len(pos), None)
+    seen = set()
+    for i, name, dose, freq, start in zip(owner, *(_column_at(df, c, pos) for c in ("name", "dose", "frequency")), starts):
+        if pd.isna(name) or (i, name, dose, freq) in seen:
+            continue
+        seen.add((i, name, dose, freq))
+        item = {"name": str(name), "dose": dose, "frequency": freq,
+                "since": None if pd.isna(start) else str(pd.Timestamp(start).date())}
+        stacks[i].append({k: v for k, v in item.items() if v is not None and not pd.isna(v)})
+    return stacks
+
+def _check_ins(bundle: DataBundle, users: List[Any], days: int = 30) -> List[Dict[str, Any]]:
+    """Per user, distinct check-in days in the ``days`` days up to their latest survey log."""
+    out = [{"check_in_days_30d": 0} for _ in users]
+    g = _gather(bundle, "surveys", users)
+    if g is None or "timestamp" not in g[0].columns:
+        return out
+    df, present, pos, codes = g
+    stamps = df["timestamp"].to_numpy()[pos]
+    if not np.issubdtype(stamps.dtype, np.datetime64):
+        return out
+    ok = ~np.isnat(stamps)
+    day, codes = stamps[ok].astype("datetime64[D]").astype(np.int64), codes[ok]
+    if len(day) == 0:
+        return out
+    last = np.full(len(present), np.iinfo(np.int64).min)
+    np.maximum.at(last, codes, day)
+    recent = day > last[codes] - days
+    counts = np.bincount(np.unique(codes[recent] * (1 << 32) + day[recent]) >> 32, minlength=len(present))
+    row_of = {u: i for i, u in enumerate(users)}
+    for c, uid in enumerate(present):
+        if counts[c]:
+            out[row_of[uid]] = {"check_in_days_30d": int(counts[c]),
+                                "last_check_in": str(np.datetime64(int(last[c]), "D"))}
+    return out
+
+def similar_users(bundle: DataBundle, user_id: Any, k: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """Users with the most similar profiles and the stacks they stayed on.
+
+    Neighbours carry their similarity, active medications and recent check-in
+    days (not their ids); ``common_stack`` counts how many neighbours take each
+    medication. None when the feature is off or the user has no features.
+    """
+    k = SIMILAR_USERS_K if k is None else k
+    index = bundle.cohort_index if k > 0 else None
+    found = index.neighbors(user_id, k) if index is not None else []
+    if not found:
         return None
+    users = [uid for uid, _ in found]
+    neighbors, common = [], {}
+    for (_, sim), stack, check_ins in zip(found, _active_stacks(bundle, users), _check_ins(bundle, users)):
+        neighbors.append({"similarity": round(sim, 3), "stack": stack, **check_ins})
+        for name in dict.fromkeys(item["name"] for item in stack):
+            n, total = common.get(name, (0, 0.0))
+            common[name] = (n + 1, total + sim)
+    ranked = sorted(common.items(), key=lambda kv: (-kv[1][0], -kv[1][1]))
+    return {"neighbors": neighbors, "common_stack": [{"name": name, "users": n} for name, (n, _) in ranked]}
 
 # ---- Rule-based fallback recommender ----
-def rule_based_recommendations(profile: Dict[str, Any], peptide_catalog: Optional[pd.DataFrame]) -> Dict[str, Any]:
+def _peptide_queries(sig: Dict[str, Any]) -> List[tuple]:
+    """(catalog keywords, cap on total peptides) for each peptide rule the signals trigger."""
+    queries = []
+    # if poor sleep/low HRV -> sleep/recovery
+    hrv = sig.get("wearable_hrv_avg")
+    if isinstance(hrv, float) and hrv < 30:
+        queries.append((["sleep", "recovery", "stress"], 5))
+    # if cognition goals found in survey
+    goals = []
+    for k, v in sig.items():
+        if "goal" in k.lower():
+            goals.extend([str(x).lower() for x in (v if isinstance(v, list) else [v])])
+    if any(g for g in goals if "focus" in g or "cognition" in g or "memory" in g):
+        queries.append((["cognition", "memory", "neuro", "brain"], 8))
+    return queries
+
+def bundle_rule_recommendations(profile: Dict[str, Any], bundle: DataBundle) -> Dict[str, Any]:
+    """rule_based_recommendations against the bundle's catalog, read only if a peptide rule fires."""
+    if not _peptide_queries(profile.get("signals", {})):
+        return rule_based_recommendations(profile, None)
+    return rule_based_recommendations(profile, bundle.main, bundle.catalog_index)
+
+def rule_based_recommendations(profile: Dict[str, Any], peptide_catalog: Optional[pd.DataFrame],
+                               catalog_index: Optional[CatalogIndex] = None) -> Dict[str, Any]:
     sig = profile.get("signals", {})
     recs = {"supplement_stack": [], "peptides": [], "nootropics": [], "notes": []}
 
@@ -288,106 +1597,418 @@ def rule_based_recommendations(profile: Dict[str, Any], peptide_catalog: Optiona
     recs["nootropics"].append("Citicoline (memory/attention)")
 
     # Peptide suggestions (informational only) from main.xlsx if has keywords
-    if peptide_catalog is not None and not peptide_catalog.empty:
-        # try to pick peptides by 'indication' like sleep, recovery, cognition
-        lower_cols = {c.lower(): c for c in peptide_catalog.columns}
-        text_cols = [lower_cols[c] for c in lower_cols if any(k in c for k in ["indication", "function", "description", "mechanism"])]
-        name_col = lower_cols.get("name") or lower_cols.get("peptide") or list(peptide_catalog.columns)[0]
-        def any_match(row, keywords):
-            blob = " ".join(str(row[c]) for c in text_cols) if text_cols else " ".join(str(x) for x in row)
-            blob_l = blob.lower()
-            return any(k in blob_l for k in keywords)
-        # if poor sleep/low HRV -> sleep/recovery
-        if isinstance(hrv, float) and hrv < 30:
-            for _, r in peptide_catalog.iterrows():
-                if any_match(r, ["sleep", "recovery", "stress"]) and len(recs["peptides"]) < 5:
-                    recs["peptides"].append(str(r.get(name_col, "Unknown")))
-        # if cognition goals found in survey
-        goals = []
-        for k, v in sig.items():
-            if "goal" in k.lower():
-                goals.extend([str(x).lower() for x in (v if isinstance(v, list) else [v])])
-        if any(g for g in goals if "focus" in g or "cognition" in g or "memory" in g):
-            for _, r in peptide_catalog.iterrows():
-                if any_match(r, ["cognition", "memory", "neuro", "brain"]) and len(recs["peptides"]) < 8:
-                    recs["peptides"].append(str(r.get(name_col, "Unknown")))
+    queries = _peptide_queries(sig)
+    if queries and peptide_catalog is not None and not peptide_catalog.empty:
+        # pick peptides by 'indication' like sleep, recovery, cognition via the keyword index
+        if catalog_index is None:
+            catalog_index = CatalogIndex(peptide_catalog)
+        for keywords, limit in queries:
+            for row_id in catalog_index.rows_matching(keywords):
+                if len(recs["peptides"]) >= limit:
+                    break
+                recs["peptides"].append(catalog_index.names[row_id])
+
+    high, low = sig.get("lab_flags_high") or [], sig.get("lab_flags_low") or []
+    if high or low:
+        parts = [f"high: {', '.join(high)}"] if high else []
+        parts += [f"low: {', '.join(low)}"] if low else []
+        recs["notes"].append(f"Lab results outside the reported reference range ({'; '.join(parts)}) - review these with a clinician.")
 
     recs["notes"].append("These are informational ideas, not medical advice. Please consult a qualified clinician before starting peptides or supplements.")
     return recs
 
 # ---- LLM wrapper (OpenAI) ----
-def llm_recommendations(profile: Dict[str, Any], peptide_catalog_sample: List[Dict[str, Any]]) -> Optional[str]:
-    
+LLM_MODEL = "gpt-4o-mini"
+LLM_TEMPERATURE = 0.2
+
+_SYSTEM_PROMPT = (
+    "You are an expert health optimization assistant specializing in cutting-edge wellness and performance. "
+    "You generate NON-medical, informational wellness suggestions only. "
+    "YOU MUST add a clear disclaimer that this is informational only, not medical advice, and to consult a qualified clinician before acting.\n"
+    "Provide recommendations in FOUR sections:\n"
+    "1. POWER-PACKED SUPPLEMENT STACK - Include vitamins, minerals, amino acids, and specific dosage ranges (e.g., 200-400 mg daily) tailored to user's biomarkers and health signals\n"
+    "2. THERAPEUTIC PEPTIDES - Recommend specific peptides (BPC-157, TB-500, Semax, Cerebrolysin, NAD+, etc.) with specific dosage ranges, personalized for user's recovery and cognitive needs\n"
+    "3. NOOTROPICS - Cognitive enhancement compounds (L-theanine, rhodiola, bacopa, etc.) with specific dosage ranges for focus and mental performance\n"
+    "4. GENERAL WELLNESS TIPS - Sleep optimization, exercise, stress management, nutrition, and lifestyle recommendations\n"
+    "Be SPECIFIC with dosage ranges (e.g., 500-1000 mg daily, 200-400 mcg daily). "
+    "Personalize ALL recommendations based on user's lab biomarkers, wearable metrics (sleep, HRV, steps), medications, and survey preferences. "
+    "Avoid contraindications if possible using the provided medication list. "
+    "Focus on power-packed, synergistic compound stacks that work well together."
+)
+
+def _load_api_key() -> Optional[str]:
     # Load .env file if it exists
     dotenv_path = Path(".") / ".env"
     if dotenv_path.exists():
+        from dotenv import load_dotenv
         load_dotenv(dotenv_path)
 
     # Now fetch key from BOTH .env and system env
-    api_key = os.getenv("OPENAI_API_KEY")
+    return os.getenv("OPENAI_API_KEY")
+
+# Prompt compaction: the user context is held to a token budget (estimated, no
+# tokenizer needed), the catalog is ranked by relevance to the user's signals and
+# merged rows are reduced to per-source statistics.
+LLM_PROMPT_TOKEN_BUDGET = int(os.getenv("LLM_PROMPT_TOKEN_BUDGET", "1500"))
+
+# catalog keywords suggested by each flagged lab marker
+_LAB_THEMES = {
+    "Vitamin D": ["vitamin d", "bone", "immune"],
+    "Omega-3 Index": ["omega", "cardio", "inflam"],
+    "LDL": ["cardio", "lipid", "cholesterol", "heart"],
+    "HDL": ["cardio", "lipid", "cholesterol", "heart"],
+    "CRP": ["inflam", "immune", "recovery", "repair"],
+    "HbA1c": ["metabolic", "glucose", "insulin", "weight"],
+    "Ferritin": ["iron", "energy", "fatigue"],
+}
+# lab flags carry the lab's own test names ("hs-CRP", "A1c"); map them back to the themed signal names
+_LAB_THEME_ALIASES = {alias: marker for marker, aliases in _LAB_MARKER_ALIASES.items()
+                      for alias in [_norm_marker(marker)] + aliases}
+_NAME_COLUMNS = ("first_name", "last_name", "name", "email", "phone", "address")
+_LABEL_COLUMNS = ("test_name", "taxa_name", "metabolite_name", "question_id")
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count for OpenAI chat models (~4 characters per token)."""
+    return (len(text) + 3) // 4
+
+def _compact_json(obj: Any) -> str:
+    return json.dumps(obj, separators=(",", ":"), default=str)
+
+def _round(v: Any) -> Any:
+    if isinstance(v, (float, np.floating)):
+        return None if np.isnan(v) else float(f"{v:.4g}")
+    if isinstance(v, dict):
+        return {k: _round(x) for k, x in v.items()}
+    if isinstance(v, list):
+        return [_round(x) for x in v]
+    return v
+
+def _signal_keywords(signals: Dict[str, Any]) -> Dict[str, float]:
+    """Catalog search terms implied by the user's signals, with relevance weights."""
+    weights: Dict[str, float] = {}
+
+    def add(terms, w):
+        for t in terms:
+            weights[t] = max(weights.get(t, 0.0), w)
+
+    for marker in list(signals.get("lab_flags_high") or []) + list(signals.get("lab_flags_low") or []):
+        themed = _LAB_THEME_ALIASES.get(_norm_marker(marker))
+        add(_LAB_THEMES.get(themed, [str(marker).lower()]), 3.0)
+    hrv, sleep = signals.get("wearable_hrv_avg"), signals.get("wearable_sleep_hours_avg")
+    if (isinstance(hrv, float) and hrv < 30) or (isinstance(sleep, float) and sleep < 6.5):
+        add(["sleep", "recovery", "stress"], 2.0)
+    rhr = signals.get("wearable_resting_hr_avg")
+    if isinstance(rhr, float) and rhr > 75:
+        add(["cardio", "stress"], 2.0)
+    steps = signals.get("wearable_steps_avg")
+    if isinstance(steps, float) and steps < 5000:
+        add(["energy", "metabolic"], 1.0)
+    for k, v in signals.items():
+        if "goal" in k.lower():
+            for g in (v if isinstance(v, list) else [v]):
+                add([t for t in re.findall(r"[a-z0-9]+", str(g).lower()) if len(t) > 3], 2.0)
+    genomic = {str(k).lower(): v for k, v in (signals.get("genomic_flags") or {}).items()
+               if any(x not in (0, False, "0", None) for x in (v if isinstance(v, list) else [v]))}
+    if any("apoe" in k for k in genomic):
+        add(["cognition", "neuro", "brain"], 1.0)
+    if any("mthfr" in k for k in genomic):
+        add(["methyl", "folate"], 1.0)
+    return weights
+
+def rank_catalog(peptide_catalog_sample: List[Dict[str, Any]], signals: Dict[str, Any],
+                 catalog_index: Optional[CatalogIndex] = None) -> List[int]:
+    """Positions of catalog entries relevant to ``signals``, most relevant first.
 
-    if not api_key:
+    Entries matching none of the signals' terms are left out, so a user with no
+    relevant entries gets an empty list rather than the head of the catalog.
+    ``catalog_index`` must index the same catalog as the sample (row i == entry i);
+    without it the entries' text is scanned directly.
+    """
+    keywords = _signal_keywords(signals)
+    n = len(peptide_catalog_sample)
+    scores = np.zeros(n)
+    for term, w in keywords.items():
+        if catalog_index is not None and len(catalog_index.names) == n:
+            rows = catalog_index._rows_for_term(term)
+        else:
+            rows = [i for i, e in enumerate(peptide_catalog_sample)
+                    if term in " ".join(str(v) for v in e.values()).lower()]
+        scores[rows] += w
+    hits = np.flatnonzero(scores)
+    return hits[np.argsort(-scores[hits], kind="stable")].tolist()
+
+def _source_parts(profile: Dict[str, Any]) -> Dict[str, pd.DataFrame]:
+    # the per-table slices from extract_user_profile, else split merged_df (slower: all-NaN columns)
+    parts = {name: profile[name] for name in _USER_TABLES
+             if isinstance(profile.get(name), pd.DataFrame) and not profile[name].empty}
+    if parts:
+        return parts
+    mdf = profile.get("merged_df")
+    if mdf is not None and not mdf.empty and "__source" in mdf.columns:
+        parts = {name: part.drop(columns="__source").dropna(axis=1, how="all")
+                 for name, part in mdf.groupby("__source", sort=False)}
+    return parts
+
+def _source_stats(parts: Dict[str, pd.DataFrame], max_labels: int = 12) -> Dict[str, Any]:
+    """Per-source summary of a user's rows.
+
+    Row count and date span, then either the latest value per label (lab test,
+    taxon, metabolite, survey question) or mean/min/max of each numeric column.
+    """
+    stats = {}
+    for name, part in parts.items():
+        entry: Dict[str, Any] = {"rows": int(len(part))}
+        dates = [c for c in _DATE_COLUMNS.get(name, []) if c in part.columns]
+        if dates:
+            d = pd.to_datetime(part[dates[0]], errors="coerce").dropna()
+            if not d.empty:
+                entry["span"] = [str(d.min().date()), str(d.max().date())]
+        numeric = [c for c, dt in part.dtypes.items()
+                   if not (str(c).lower().endswith("id") or str(c).lower() in ("ref_low", "ref_high") + _NAME_COLUMNS)
+                   and pd.api.types.is_numeric_dtype(dt) and not pd.api.types.is_bool_dtype(dt)]
+        label = next((c for c in _LABEL_COLUMNS if c in part.columns), None)
+        if label is not None and numeric:
+            last = part.dropna(subset=[numeric[0]]).drop_duplicates(label, keep="last")
+            entry["latest"] = _round({str(k): float(v) for k, v in
+                                      zip(last[label].tolist()[-max_labels:], last[numeric[0]].tolist()[-max_labels:])})
+        elif numeric:
+            summary = {}
+            for c in numeric:
+                v = part[c].to_numpy(dtype=float)
+                v = v[~np.isnan(v)]
+                if v.size:
+                    summary[c] = v[0] if v.size == 1 else [v.mean(), v.min(), v.max()]
+            if summary:
+                entry["mean_min_max"] = _round(summary)
+        stats[name] = entry
+    return stats
+
+def build_llm_context(profile: Dict[str, Any], peptide_catalog_sample: List[Dict[str, Any]],
+                      catalog_index: Optional[CatalogIndex] = None,
+                      token_budget: Optional[int] = None) -> Dict[str, Any]:
+    """The user context sent to the LLM (also the basis of the response-cache key).
+
+    Holds the rounded signals, per-source statistics of the merged rows and the
+    catalog entries most relevant to the signals, adding entries in relevance order
+    while the compact JSON stays within ``token_budget`` (LLM_PROMPT_TOKEN_BUDGET).
+    """
+    budget = LLM_PROMPT_TOKEN_BUDGET if token_budget is None else token_budget
+    signals = profile.get("signals", {})
+    context = {
+        "user_signals": _round({k: v for k, v in signals.items() if v not in (None, [], {})}),
+        "source_stats": _source_stats(_source_parts(profile)),
+        "peptide_catalog": [],
+    }
+    used = estimate_tokens(_compact_json(context))
+    # over budget before any catalog entry: drop the least informative source summaries
+    for name in sorted(context["source_stats"], key=lambda s: context["source_stats"][s]["rows"]):
+        if used <= budget:
+            break
+        context["source_stats"].pop(name)
+        used = estimate_tokens(_compact_json(context))
+    for pos in rank_catalog(peptide_catalog_sample, signals, catalog_index):
+        cost = estimate_tokens(_compact_json(peptide_catalog_sample[pos])) + 1
+        if used + cost > budget:
+            break
+        context["peptide_catalog"].append(peptide_catalog_sample[pos])
+        used += cost
+    return context
+
+def _uncompacted_llm_context(profile: Dict[str, Any], peptide_catalog_sample: List[Dict[str, Any]]) -> Dict[str, Any]:
+    # the previous prompt layout (raw merged rows, unranked catalog); kept for prompt_token_report
+    merged_sample = None
+    mdf = profile.get("merged_df")
+    if mdf is not None and not mdf.empty:
+        cols = [c for c in list(mdf.columns) if c != "__source"][:8]
+        merged_sample = [{c: (None if pd.isna(r[c]) else r[c]) for c in cols} for _, r in mdf.head(20).iterrows()]
+    signals = profile.get("signals", {})
+    return {
+        "user_signals": signals,
+        "current_meds": signals.get("current_meds", []),
+        "survey_prefs": {k: v for k, v in signals.items() if "survey_" in k},
+        "merged_user_rows": merged_sample,
+        "peptide_catalog_sample": peptide_catalog_sample[:50],
+    }
+
+def prompt_token_report(profile: Dict[str, Any], peptide_catalog_sample: List[Dict[str, Any]],
+                        catalog_index: Optional[CatalogIndex] = None,
+                        token_budget: Optional[int] = None) -> Dict[str, int]:
+    """Estimated prompt tokens of the uncompacted vs compacted user message."""
+    before = json.dumps(_uncompacted_llm_context(profile, peptide_catalog_sample), indent=2, default=str)
+    context = build_llm_context(profile, peptide_catalog_sample, catalog_index, token_budget)
+    after = build_llm_messages(profile, context)[1]["content"]
+    return {
+        "before": estimate_tokens(before),
+        "after": estimate_tokens(after),
+        "budget": LLM_PROMPT_TOKEN_BUDGET if token_budget is None else token_budget,
+        "catalog_entries": len(context["peptide_catalog"]),
+        "system_prompt": estimate_tokens(_SYSTEM_PROMPT),
+    }
+
+def build_llm_messages(profile: Dict[str, Any], context: Dict[str, Any]) -> List[Dict[str, str]]:
+    user_blob = _compact_json(context)
+    return [
+        {"role": "system", "content": _SYSTEM_PROMPT},
+        {"role": "user", "content": f"Create recommendations for USERID={profile.get('USERID')} using this context:\n{user_blob}"}
+    ]
+
+def llm_cache_key(profile: Dict[str, Any], context: Dict[str, Any]) -> str:
+    from llm_cache import cache_key
+    return cache_key({"USERID": profile.get("USERID"), "context": context}, _SYSTEM_PROMPT, LLM_MODEL, LLM_TEMPERATURE)
+
+_LLM_CACHE: Optional["LLMCache"] = None
+_LLM_CACHE_LOCK = threading.Lock()
+
+def get_llm_cache() -> Optional["LLMCache"]:
+    """Process-wide response cache at $LLM_CACHE_PATH (default .cache/llm_responses.sqlite3).
+
+    Setting LLM_CACHE_PATH to an empty string disables caching.
+    """
+    global _LLM_CACHE
+    from llm_cache import DEFAULT_PATH, LLMCache
+    path = os.getenv("LLM_CACHE_PATH", DEFAULT_PATH)
+    if not path:
         return None
+    with _LLM_CACHE_LOCK:
+        if _LLM_CACHE is None or _LLM_CACHE.path != path:
+            _LLM_CACHE = LLMCache(path)
+        return _LLM_CACHE
+
+def _complete(client, msg: List[Dict[str, str]]) -> Optional[str]:
+    # Use responses API if available; fall back to chat.completions
     try:
-        from openai import OpenAI
-        client = OpenAI(api_key=api_key)
-        sys_prompt = (
-            "You are an expert health optimization assistant specializing in cutting-edge wellness and performance. "
-            "You generate NON-medical, informational wellness suggestions only. "
-            "YOU MUST add a clear disclaimer that this is informational only, not medical advice, and to consult a qualified clinician before acting.\n"
-            "Provide recommendations in FOUR sections:\n"
-            "1. POWER-PACKED SUPPLEMENT STACK - Include vitamins, minerals, amino acids, and specific dosage ranges (e.g., 200-400 mg daily) tailored to user's biomarkers and health signals\n"
-            "2. THERAPEUTIC PEPTIDES - Recommend specific peptides (BPC-157, TB-500, Semax, Cerebrolysin, NAD+, etc.) with specific dosage ranges, personalized for user's recovery and cognitive needs\n"
-            "3. NOOTROPICS - Cognitive enhancement compounds (L-theanine, rhodiola, bacopa, etc.) with specific dosage ranges for focus and mental performance\n"
-            "4. GENERAL WELLNESS TIPS - Sleep optimization, exercise, stress management, nutrition, and lifestyle recommendations\n"
-            "Be SPECIFIC with dosage ranges (e.g., 500-1000 mg daily, 200-400 mcg daily). "
-            "Personalize ALL recommendations based on user's lab biomarkers, wearable metrics (sleep, HRV, steps), medications, and survey preferences. "
-            "Avoid contraindications if possible using the provided medication list. "
-            "Focus on power-packed, synergistic compound stacks that work well together."
-        )
-        # Build a compact merged-sample from profile['merged_df'] if available.
-        merged_sample = None
-        try:
-            mdf = profile.get("merged_df")
-            if mdf is not None and not mdf.empty:
-                # select up to 8 informative columns (avoid internal __source) and up to 20 rows
-                cols = [c for c in list(mdf.columns) if c != "__source"]
-                cols = cols[:8]
-                rows = min(20, len(mdf))
-                merged_sample = [
-                    {c: (None if pd.isna(r[c]) else r[c]) for c in cols}
-                    for _, r in mdf.head(rows).iterrows()
-                ]
-        except Exception:
-            merged_sample = None
-
-        user_blob = json.dumps({
-            "user_signals": profile.get("signals", {}),
-            "current_meds": profile.get("signals", {}).get("current_meds", []),
-            "survey_prefs": {k:v for k,v in profile.get("signals", {}).items() if "survey_" in k},
-            "merged_user_rows": merged_sample,
-            "peptide_catalog_sample": peptide_catalog_sample[:50],
-        }, indent=2)
-        msg = [
-            {"role": "system", "content": sys_prompt},
-            {"role": "user", "content": f"Create recommendations for USERID={profile.get('USERID')} using this context:\n{user_blob}"}
-        ]
-        # Use responses API if available; fall back to chat.completions
-        try:
-            resp = client.chat.completions.create(model="gpt-4o-mini", messages=msg, temperature=0.2)
-            return resp.choices[0].message.content
-        except Exception:
-            resp = client.responses.create(model="gpt-4o-mini", input=msg, temperature=0.2)
-            return resp.output_text
-    except Exception:
+        resp = client.chat.completions.create(model=LLM_MODEL, messages=msg, temperature=LLM_TEMPERATURE)
+        return resp.choices[0].message.content
+    except Exception as exc:
+        instrument.record_error("llm.chat", exc)
+        resp = client.responses.create(model=LLM_MODEL, input=msg, temperature=LLM_TEMPERATURE)
+        return resp.output_text
+
+def llm_recommendations(profile: Dict[str, Any], peptide_catalog_sample: List[Dict[str, Any]],
+                        client: Any = None, use_cache: bool = True,
+                        catalog_index: Optional[CatalogIndex] = None) -> Optional[str]:
+    """LLM-drafted recommendations, or None when no API key/client is available or the call fails.
+
+    Responses are served from the persistent response cache when the same
+    context, prompt, model and temperature were answered before. ``client`` can be
+    any OpenAI-compatible client (e.g. a local stub); by default one is created
+    from OPENAI_API_KEY.
+    """
+    api_key = None
+    if client is None:
+        api_key = _load_api_key()
+        if not api_key:
+            return None
+    try:
+        with instrument.span("llm.context"):
+            context = build_llm_context(profile, peptide_catalog_sample, catalog_index)
+        cache = get_llm_cache() if use_cache else None
+        key = llm_cache_key(profile, context) if cache is not None else None
+        if cache is not None:
+            with instrument.span("llm.cache"):
+                cached = cache.get(key)
+            instrument.count("llm_cache.hit" if cached is not None else "llm_cache.miss")
+            if cached is not None:
+                return cached
+        if client is None:
+            from openai import OpenAI
+            client = OpenAI(api_key=api_key)
+        with instrument.span("llm.call"):
+            text = _complete(client, build_llm_messages(profile, context))
+        if cache is not None and text:
+            cache.put(key, text, LLM_MODEL)
+        return text
+    except Exception as exc:
+        instrument.record_error("llm", exc)
         return None
 
-def build_recommendations(user_id: Any) -> Dict[str, Any]:
-    bundle = DataBundle.load()
+def llm_recommendations_stream(profile: Dict[str, Any], peptide_catalog_sample: List[Dict[str, Any]],
+                               client: Any = None, use_cache: bool = True,
+                               catalog_index: Optional[CatalogIndex] = None) -> Optional[Iterator[str]]:
+    """Streaming variant of llm_recommendations.
+
+    Returns None when no API key/client is available; otherwise an iterator of
+    text chunks as the model produces them (a cached response arrives as one
+    chunk). Errors while streaming propagate to the caller, and the full text is
+    written to the response cache only once the stream completes.
+    """
+    api_key = None
+    if client is None:
+        api_key = _load_api_key()
+        if not api_key:
+            return None
+    with instrument.span("llm.context"):
+        context = build_llm_context(profile, peptide_catalog_sample, catalog_index)
+    cache = get_llm_cache() if use_cache else None
+    key = llm_cache_key(profile, context) if cache is not None else None
+
+    def chunks():
+        nonlocal client
+        if cache is not None:
+            cached = cache.get(key)
+            instrument.count("llm_cache.hit" if cached is not None else "llm_cache.miss")
+            if cached is not None:
+                yield cached
+                return
+        if client is None:
+            from openai import OpenAI
+            client = OpenAI(api_key=api_key)
+        stream = client.chat.completions.create(model=LLM_MODEL, messages=build_llm_messages(profile, context),
+                                                temperature=LLM_TEMPERATURE, stream=True)
+        parts = []
+        for event in stream:
+            if not event.choices:
+                continue
+            delta = event.choices[0].delta.content
+            if delta:
+                parts.append(delta)
+                yield delta
+        if cache is not None and parts:
+            cache.put(key, "".join(parts), LLM_MODEL)
+
+    return chunks()
 
-    # First, verify the user exists in at least one data source and build a merged dataframe
-    merged = assemble_user_dataframe(bundle, user_id)
-    if merged is None:
+def catalog_prompt_sample(bundle: DataBundle) -> List[Dict[str, Any]]:
+    """Every catalog row (key columns only, in catalog order so entry i is catalog_index row i).
+
+    build_llm_context picks the relevant entries that fit the token budget. Built
+    once per bundle (and carried over while the catalog is unchanged).
+    """
+    if bundle.catalog_sample is not None:
+        return bundle.catalog_sample
+    peptide_catalog = bundle.main
+    sample = []
+    if peptide_catalog is not None and not peptide_catalog.empty:
+        # Sample key columns to reduce prompt size; drop empty cells
+        cols = peptide_catalog.columns[:8].tolist()
+        for vals in peptide_catalog[cols].itertuples(index=False, name=None):
+            sample.append({c: v for c, v in zip(cols, vals) if not pd.isna(v)})
+    bundle.catalog_sample = sample
+    return sample
+
+def build_recommendations(user_id: Any, client: Any = None, timings: bool = False,
+                          bundle: Optional[DataBundle] = None, similar: int = 0) -> Dict[str, Any]:
+    """Recommendations for one user: LLM-drafted when a key/``client`` is available, else rule-based.
+
+    Every call is traced (see instrument.py); with ``timings=True`` the result also
+    carries the per-stage milliseconds, counters and any swallowed errors. Pass
+    ``bundle`` to serve from an already loaded bundle instead of DataBundle.load().
+    ``similar=k`` attaches the ``k`` users with the most similar profiles (see similar_users).
+    """
+    with instrument.trace("build_recommendations", user_id=str(user_id)) as tr:
+        result = _build_recommendations(user_id, client, bundle, similar)
+    if timings:
+        result["timings"] = tr.as_dict()
+    return result
+
+def _build_recommendations(user_id: Any, client: Any = None, bundle: Optional[DataBundle] = None,
+                           similar: int = 0) -> Dict[str, Any]:
+    if bundle is None:
+        with instrument.span("load"):
+            bundle = DataBundle.load()
+
+    # First, verify the user exists in at least one data source (O(1) index lookup)
+    if not bundle.has_user(user_id):
         # user not found anywhere - short-circuit to avoid unnecessary LLM calls
         return {
             "engine": "no_data",
@@ -395,25 +2016,160 @@ def build_recommendations(user_id: Any) -> Dict[str, Any]:
             "message": f"User {user_id} not found in any data source."
         }
 
-    # proceed to build the detailed profile (keeps per-source slices as well)
-    profile = extract_user_profile(bundle, user_id)
-    # attach merged dataframe for downstream use / debugging
-    profile["merged_df"] = merged
-
-    # Load peptide catalog (main.xlsx) and convert a tiny sample for the LLM
-    peptide_catalog = bundle.main
-    sample = []
-    if peptide_catalog is not None and not peptide_catalog.empty:
-        # Sample key columns to reduce prompt size
-        cols = peptide_catalog.columns[:8].tolist()
-        for _, r in peptide_catalog.head(80).iterrows():
-            sample.append({c: (None if pd.isna(r[c]) else r[c]) for c in cols})
+    # proceed to build the detailed profile (keeps per-source slices; merged_df is built on access)
+    with instrument.span("profile"):
+        profile = extract_user_profile(bundle, user_id)
 
-    # Try LLM first (if key present)
-    llm_txt = llm_recommendations(profile, sample)
+    # Try LLM first (if key present); only then is the catalog (main.xlsx) needed for the prompt
+    llm_txt = None
+    if client is not None or _load_api_key():
+        with instrument.span("catalog_sample"):
+            sample = catalog_prompt_sample(bundle)
+        with instrument.span("llm"):
+            llm_txt = llm_recommendations(profile, sample, client=client, catalog_index=bundle.catalog_index)
     if llm_txt is None:
         # Rule-based fallback
-        recs = rule_based_recommendations(profile, peptide_catalog)
-        return {"engine": "rule_based", "profile_signals": profile.get("signals", {}), "recommendations": recs}
+        with instrument.span("rules"):
+            recs = bundle_rule_recommendations(profile, bundle)
+        result = {"engine": "rule_based", "profile_signals": profile.get("signals", {}), "recommendations": recs}
     else:
-        return {"engine": "llm", "profile_signals": profile.get("signals", {}), "recommendations_text": llm_txt}
+        result = {"engine": "llm", "profile_signals": profile.get("signals", {}), "recommendations_text": llm_txt}
+    return _with_similar_users(result, bundle, user_id, similar)
+
+def _with_similar_users(result: Dict[str, Any], bundle: DataBundle, user_id: Any, k: int) -> Dict[str, Any]:
+    if k <= 0:
+        return result
+    # similar profiles are context for the plan; a failure here must not cost the recommendations
+    try:
+        with instrument.span("similar_users"):
+            similar = similar_users(bundle, user_id, k)
+    except Exception as exc:
+        instrument.record_error("similar_users", exc)
+        similar = None
+    if similar is not None:
+        result["similar_users"] = similar
+    return result
+
+def build_recommendations_stream(user_id: Any, client: Any = None, similar: int = 0) -> Iterator[Dict[str, Any]]:
+    """Progressive build_recommendations for UIs.
+
+    Yields events as dicts with an ``event`` key:
+      - "fallback": the rule-based result, available immediately as a placeholder
+      - "delta": the next chunk of LLM text (``text``)
+      - "done": the final result, shaped like build_recommendations' return value
+    Unknown users produce a single "done" event with the no_data result.
+    """
+    bundle = DataBundle.load()
+    if not bundle.has_user(user_id):
+        yield {"event": "done", "result": {
+            "engine": "no_data",
+            "profile_signals": {},
+            "message": f"User {user_id} not found in any data source."
+        }}
+        return
+
+    profile = extract_user_profile(bundle, user_id)
+    signals = profile.get("signals", {})
+    recs = bundle_rule_recommendations(profile, bundle)
+    fallback = _with_similar_users({"engine": "rule_based", "profile_signals": signals, "recommendations": recs},
+                                   bundle, user_id, similar)
+    yield {"event": "fallback", "result": fallback}
+
+    stream = None
+    if client is not None or _load_api_key():
+        stream = llm_recommendations_stream(profile, catalog_prompt_sample(bundle), client=client,
+                                            catalog_index=bundle.catalog_index)
+    if stream is None:
+        yield {"event": "done", "result": fallback}
+        return
+    parts = []
+    try:
+        for chunk in stream:
+            parts.append(chunk)
+            yield {"event": "delta", "text": chunk}
+    except Exception as exc:
+        # a broken stream falls back to the rule-based plan
+        instrument.record_error("llm", exc)
+        yield {"event": "done", "result": fallback}
+        return
+    if not parts:
+        yield {"event": "done", "result": fallback}
+        return
+    result = {"engine": "llm", "profile_signals": signals, "recommendations_text": "".join(parts)}
+    if "similar_users" in fallback:
+        result["similar_users"] = fallback["similar_users"]
+    yield {"event": "done", "result": result}
+
+# ---- Batch (cohort) recommendations ----
+_WORKER_CATALOG: Optional[pd.DataFrame] = None
+_WORKER_CATALOG_INDEX: Optional[CatalogIndex] = None
+
+def _init_rule_worker(peptide_catalog: Optional[pd.DataFrame], catalog_index: Optional[CatalogIndex] = None) -> None:
+    # runs once per pool process so the catalog (and its index) is not pickled with every task
+    global _WORKER_CATALOG, _WORKER_CATALOG_INDEX
+    _WORKER_CATALOG = peptide_catalog
+    _WORKER_CATALOG_INDEX = catalog_index
+    if catalog_index is None and peptide_catalog is not None and not peptide_catalog.empty:
+        _WORKER_CATALOG_INDEX = CatalogIndex(peptide_catalog)
+
+def _rule_result(user_id: Any, signals: Dict[str, Any], peptide_catalog: Optional[pd.DataFrame],
+                 catalog_index: Optional[CatalogIndex]) -> Dict[str, Any]:
+    recs = rule_based_recommendations({"signals": signals}, peptide_catalog, catalog_index)
+    return {"USERID": user_id, "engine": "rule_based", "profile_signals": signals, "recommendations": recs}
+
+def _rule_stage(item) -> Dict[str, Any]:
+    user_id, signals = item
+    return _rule_result(user_id, signals, _WORKER_CATALOG, _WORKER_CATALOG_INDEX)
+
+def cohort_user_ids(bundle: DataBundle) -> List[Any]:
+    """Every USERID in pilot_user_data.csv (file order), or all indexed users if it is missing."""
+    df = bundle.pilot_user
+    key = bundle._table_key(df) if df is not None and not df.empty else None
+    if key is None:
+        return sorted(bundle.all_users, key=str)
+    return df[key].dropna().unique().tolist()
+
+def build_recommendations_batch(user_ids: Optional[List[Any]] = None, workers: Optional[int] = None,
+                                chunksize: int = 32, bundle: Optional[DataBundle] = None) -> Iterator[Dict[str, Any]]:
+    """Rule-based recommendations for many users, yielded in input order.
+
+    The bundle is loaded once, signals for the whole cohort come from
+    extract_cohort_signals, and the rule stage is fanned out over ``workers``
+    processes (``workers`` <= 1 runs it inline). ``user_ids=None`` means every user
+    in pilot_user_data.csv. Each result is traced as "build_recommendations_batch";
+    the shared load and signal passes are timed as spans outside those traces.
+    """
+    if bundle is None:
+        with instrument.span("load"):
+            bundle = DataBundle.load()
+    if user_ids is None:
+        user_ids = cohort_user_ids(bundle)
+    with instrument.span("cohort_signals"):
+        signals = extract_cohort_signals(bundle, user_ids)
+
+    def missing(user_id):
+        return {"USERID": user_id, "engine": "no_data", "profile_signals": {},
+                "message": f"User {user_id} not found in any data source."}
+
+    found = [(u, signals[u]) for u in user_ids if u in signals]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        # inline: no worker globals, so concurrent callers with different bundles do not interfere
+        results = (_rule_result(u, sig, bundle.main, bundle.catalog_index) for u, sig in found)
+        pool = None
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_rule_worker,
+                                   initargs=(bundle.main, bundle.catalog_index))
+        results = pool.map(_rule_stage, found, chunksize=chunksize)
+    try:
+        for user_id in user_ids:
+            # with a pool, "rules" is the wait for the worker's result
+            with instrument.trace("build_recommendations_batch", user_id=str(user_id)):
+                with instrument.span("rules"):
+                    result = next(results) if user_id in signals else missing(user_id)
+            yield result
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
@@ -0,0 +1,263 @@
+"""HTTP API over a warm, in-memory DataBundle (stdlib only).
+
+  python server.py --port 8000
+
+The bundle is loaded and indexed once at startup and shared by every request
+thread. Endpoints (JSON unless noted):
+
+  GET  /recommendations/{user_id}[?timings=1]   same result as build_recommendations
+  GET  /users/{user_id}/profile                 signals and per-source row counts
+  POST /recommendations/batch                   {"user_ids": [...]} -> rule-based results, input order
+  POST /reload[?full=1]                         build a fresh bundle and swap it in
+  GET  /health                                  bundle generation and user count
+  GET  /metrics                                 stage timings/counters, Prometheus text format
+
+``/reload`` builds the new bundle beside the live one (only changed files are
+re-parsed unless ``full=1``) and then swaps a single reference; requests already
+running keep the bundle they started with, so nothing is dropped. SIGHUP does the
+same.
+
+Request threads share one interpreter, so CPU-bound throughput is capped by the
+GIL; ``--workers N`` (POSIX) forks N processes after the bundle is loaded, which
+share its pages copy-on-write and accept from the same socket. A ``/reload``
+served by any worker is forwarded to the others through the parent (SIGHUP);
+``/metrics`` and ``/health`` describe the worker that answered.
+"""
+import argparse
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import instrument
+from rec_engine import (
+    SIMILAR_USERS_K, _USER_TABLES, DataBundle, UserView, build_recommendations, build_recommendations_batch,
+    catalog_prompt_sample,
+)
+
+MAX_BATCH = 10000
+MAX_BODY = 4 * 1024 * 1024
+
+
+class RecommendationService:
+    """Holds the live bundle; every read takes one reference to it and uses only that."""
+
+    def __init__(self, data_dir: str = "data", catalog_path: str = "main.xlsx"):
+        self.data_dir = data_dir
+        self.catalog_path = catalog_path
+        self._reload_lock = threading.Lock()
+        self.generation = 0
+        self.loaded_at = 0.0
+        self.bundle = None
+        self.on_reload = None   # called after an API-triggered reload (the pre-fork parent fans it out)
+        self.reload()
+
+    def _build(self, full: bool) -> DataBundle:
+        bundle = DataBundle.load(self.data_dir, self.catalog_path, use_cache=not full)
+        catalog_prompt_sample(bundle)  # warm the per-bundle prompt sample before it goes live
+        if SIMILAR_USERS_K > 0:
+            bundle.cohort_index        # and the similarity index (incrementally updated on appends)
+        return bundle
+
+    def reload(self, full: bool = False, notify: bool = False) -> Dict[str, Any]:
+        with self._reload_lock:
+            start = time.perf_counter()
+            with instrument.span("server.reload"):
+                bundle = self._build(full)
+            swapped = bundle is not self.bundle
+            if swapped:
+                self.bundle = bundle
+                self.generation += 1
+                self.loaded_at = time.time()
+            result = {"generation": self.generation, "swapped": swapped, "users": len(bundle.all_users),
+                      "seconds": round(time.perf_counter() - start, 3)}
+        if notify and self.on_reload is not None:
+            self.on_reload()
+        return result
+
+    def health(self) -> Dict[str, Any]:
+        bundle = self.bundle
+        return {"status": "ok", "generation": self.generation, "loaded_at": self.loaded_at,
+                "users": len(bundle.all_users)}
+
+    def recommendations(self, user_id: str, timings: bool = False) -> Dict[str, Any]:
+        return build_recommendations(user_id, timings=timings, bundle=self.bundle, similar=SIMILAR_USERS_K)
+
+    def profile(self, user_id: str) -> Optional[Dict[str, Any]]:
+        bundle = self.bundle
+        if not bundle.has_user(user_id):
+            return None
+        view = UserView(bundle, user_id)
+        return {"USERID": user_id, "signals": view["signals"],
+                "sources": {name: len(view[name]) for name in _USER_TABLES if view[name] is not None}}
+
+    def batch(self, user_ids: List[str]) -> List[Dict[str, Any]]:
+        return list(build_recommendations_batch(user_ids, workers=1, bundle=self.bundle))
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive: clients reuse connections
+    disable_nagle_algorithm = True  # headers and body are separate writes; avoid the delayed-ACK stall
+    server_version = "RecEngine/1.0"
+    service: RecommendationService = None
+    quiet = True
+
+    def log_message(self, fmt, *args):
+        if not self.quiet:
+            super().log_message(fmt, *args)
+
+    def _send(self, status: int, body: Any, content_type: str = "application/json") -> None:
+        data = body.encode() if isinstance(body, str) else json.dumps(body, default=str).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _route(self) -> Tuple[List[str], Dict[str, List[str]]]:
+        url = urlsplit(self.path)
+        return [unquote(p) for p in url.path.strip("/").split("/") if p], parse_qs(url.query)
+
+    def _read_json(self) -> Any:
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_BODY:
+            raise ValueError("request body too large")
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        parts, query = self._route()
+        svc = self.service
+        try:
+            if parts == ["health"]:
+                return self._send(200, svc.health())
+            if parts == ["metrics"]:
+                return self._send(200, instrument.METRICS.prometheus_text(), "text/plain; version=0.0.4")
+            if len(parts) == 2 and parts[0] == "recommendations":
+                timings = query.get("timings", ["0"])[0] not in ("0", "false", "")
+                with instrument.span("server.recommendations"):
+                    result = svc.recommendations(parts[1], timings)
+                return self._send(404 if result.get("engine") == "no_data" else 200, result)
+            if len(parts) == 3 and parts[0] == "users" and parts[2] == "profile":
+                with instrument.span("server.profile"):
+                    result = svc.profile(parts[1])
+                if result is None:
+                    return self._send(404, {"error": f"User {parts[1]} not found in any data source."})
+                return self._send(200, result)
+            return self._send(404, {"error": "not found"})
+        except Exception as exc:
+            instrument.record_error("server", exc)
+            return self._send(500, {"error": f"{type(exc).__name__}: {exc}"})
+
+    def do_POST(self):
+        parts, query = self._route()
+        svc = self.service
+        try:
+            if parts == ["reload"]:
+                full = query.get("full", ["0"])[0] not in ("0", "false", "")
+                return self._send(200, svc.reload(full, notify=True))
+            if parts == ["recommendations", "batch"]:
+                try:
+                    body = self._read_json()
+                    user_ids = body.get("user_ids") if isinstance(body, dict) else body
+                    if not isinstance(user_ids, list) or len(user_ids) > MAX_BATCH:
+                        raise ValueError(f"expected {{\"user_ids\": [...]}} with at most {MAX_BATCH} ids")
+                except ValueError as exc:
+                    return self._send(400, {"error": str(exc)})
+                with instrument.span("server.batch"):
+                    results = svc.batch([str(u) for u in user_ids])
+                return self._send(200, {"results": results})
+            return self._send(404, {"error": "not found"})
+        except Exception as exc:
+            instrument.record_error("server", exc)
+            return self._send(500, {"error": f"{type(exc).__name__}: {exc}"})
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+def make_server(host: str = "127.0.0.1", port: int = 8000, service: Optional[RecommendationService] = None,
+                quiet: bool = True) -> Server:
+    handler = type("BoundHandler", (Handler,), {"service": service or RecommendationService(), "quiet": quiet})
+    return Server((host, port), handler)
+
+
+def _reload_in_background(service: RecommendationService) -> None:
+    # signal handlers must not block; the swap itself is thread-safe
+    threading.Thread(target=service.reload, daemon=True).start()
+
+
+def serve_prefork(server: Server, workers: int) -> None:
+    """Fork ``workers`` processes that all serve ``server``'s socket; the parent supervises."""
+    service = server.RequestHandlerClass.service
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)   # the parent decides when to stop
+            signal.signal(signal.SIGHUP, lambda *_: _reload_in_background(service))
+            service.on_reload = lambda: os.kill(os.getppid(), signal.SIGHUP)
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    def forward(signum, _frame):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGHUP if signum == signal.SIGHUP else signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGHUP, forward)
+    signal.signal(signal.SIGTERM, forward)
+    try:
+        for _ in children:
+            os.wait()
+    except KeyboardInterrupt:
+        forward(signal.SIGTERM, None)
+        for _ in children:
+            try:
+                os.wait()
+            except ChildProcessError:
+                break
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recommendation HTTP API over a warm in-memory bundle")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--data-dir", default="data")
+    parser.add_argument("--catalog", default="main.xlsx", help="Peptide catalog path")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Processes sharing the loaded bundle (POSIX only; default 1 = threads only)")
+    parser.add_argument("--access-log", action="store_true", help="Log every request to stderr")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    service = RecommendationService(args.data_dir, args.catalog)
+    server = make_server(args.host, args.port, service, quiet=not args.access_log)
+    workers = args.workers if hasattr(os, "fork") else 1
+    print(f"Loaded {len(service.bundle.all_users)} users in {time.perf_counter() - start:.2f}s; "
+          f"serving on http://{args.host}:{args.port} ({workers} worker{'s' if workers > 1 else ''})", file=sys.stderr)
+    try:
+        if workers > 1:
+            serve_prefork(server, workers)
+        else:
+            signal.signal(signal.SIGHUP, lambda *_: _reload_in_background(service))
+            server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Columnar binary snapshot of the DataBundle source tables.
+
+A snapshot is a directory holding one NumPy ``.npy`` file per column plus a
+``manifest.json``. String columns are stored as categorical codes with a fixed-width
+unicode categories array, datetimes as int64 ticks and numerics as-is, so every file
+can be memory-mapped read-only and shared between worker processes.
+
+The manifest records the (mtime_ns, size) of each source file at compile time; a
+table is only served from the snapshot while its source still has that signature.
+"""
+import json
+import os
+import shutil
+from typing import Dict, Optional
+
+import numpy as np
+import pandas as pd
+
+MANIFEST = "manifest.json"
+FORMAT_VERSION = 2  # 2: compact load-time schema (categoricals, downcast ints, no surrogate ids)
+
+
+def _codes_dtype(n_categories: int):
+    for dt in (np.int8, np.int16, np.int32):
+        if n_categories < np.iinfo(dt).max:
+            return dt
+    return np.int64
+
+
+def _encode_column(s: pd.Series, prefix: str, out_dir: str) -> Dict[str, str]:
+    """Write one column to ``out_dir`` and return its manifest entry."""
+    entry = {"name": str(s.name)}
+    if isinstance(s.dtype, pd.DatetimeTZDtype):
+        s = s.dt.tz_convert(None)
+    if pd.api.types.is_datetime64_dtype(s.dtype):
+        entry["kind"] = "datetime"
+        entry["dtype"] = str(s.dtype)
+        np.save(os.path.join(out_dir, prefix + ".npy"), s.to_numpy().view("int64"))
+        return entry
+    if pd.api.types.is_bool_dtype(s.dtype) or (
+            pd.api.types.is_numeric_dtype(s.dtype) and not isinstance(s.dtype, pd.CategoricalDtype)):
+        entry["kind"] = "numeric"
+        np.save(os.path.join(out_dir, prefix + ".npy"), s.to_numpy())
+        return entry
+    # strings, mixed objects and categoricals -> categorical codes
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        cat = s.cat.remove_unused_categories().array
+        categories = cat.categories.astype(str)
+    else:
+        cat = pd.Categorical(s.map(lambda v: v if pd.isna(v) else str(v)))
+        categories = cat.categories
+    entry["kind"] = "category"
+    np.save(os.path.join(out_dir, prefix + ".npy"), cat.codes.astype(_codes_dtype(len(categories))))
+    np.save(os.path.join(out_dir, prefix + ".cats.npy"), np.asarray(categories, dtype=str))
+    return entry
+
+
+def _decode_column(entry: Dict[str, str], prefix: str, snap_dir: str):
+    values = np.load(os.path.join(snap_dir, prefix + ".npy"), mmap_mode="r")
+    if entry["kind"] == "datetime":
+        return values.view(entry["dtype"])
+    if entry["kind"] == "category":
+        categories = np.load(os.path.join(snap_dir, prefix + ".cats.npy"))
+        return pd.Categorical.from_codes(values, categories)
+    return values
+
+
+def write_snapshot(tables: Dict[str, Optional[pd.DataFrame]], sources: Dict[str, Optional[tuple]], out_dir: str) -> str:
+    """Write ``tables`` to a fresh snapshot directory at ``out_dir``.
+
+    ``sources`` maps each table name to the signature of the file it was parsed
+    from (as returned by ``rec_engine._file_signature``). The new snapshot is built
+    beside ``out_dir`` and swapped in, so readers never see a half-written one.
+    """
+    tmp_dir = f"{out_dir}.tmp-{os.getpid()}"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    manifest = {"version": FORMAT_VERSION, "tables": {}}
+    for name, df in tables.items():
+        sig = sources.get(name)
+        if df is None or sig is None:
+            continue
+        columns = []
+        for i, col in enumerate(df.columns):
+            columns.append(_encode_column(df[col], f"{name}.{i}", tmp_dir))
+        manifest["tables"][name] = {
+            "source": {"mtime_ns": sig[1], "size": sig[2]},
+            "rows": int(len(df)),
+            "columns": columns,
+        }
+    with open(os.path.join(tmp_dir, MANIFEST), "w") as fh:
+        json.dump(manifest, fh, indent=1)
+
+    old_dir = f"{out_dir}.old-{os.getpid()}"
+    if os.path.exists(out_dir):
+        os.replace(out_dir, old_dir)
+    os.replace(tmp_dir, out_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return out_dir
+
+
+def read_manifest(snap_dir: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(snap_dir, MANIFEST)) as fh:
+            manifest = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("version") != FORMAT_VERSION:
+        return None
+    return manifest
+
+
+def read_table(snap_dir: str, name: str, source_sig: Optional[tuple], manifest: Optional[dict] = None) -> Optional[pd.DataFrame]:
+    """Memory-map table ``name`` from the snapshot, or None if it is missing or stale."""
+    if source_sig is None:
+        return None
+    if manifest is None:
+        manifest = read_manifest(snap_dir)
+    meta = (manifest or {}).get("tables", {}).get(name)
+    if meta is None or meta["source"] != {"mtime_ns": source_sig[1], "size": source_sig[2]}:
+        return None
+    try:
+        data = {}
+        for i, entry in enumerate(meta["columns"]):
+            data[entry["name"]] = _decode_column(entry, f"{name}.{i}", snap_dir)
+        return pd.DataFrame(data, copy=False)
+    except (OSError, ValueError, KeyError):
+        return None